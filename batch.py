@@ -0,0 +1,162 @@
+import os
+import re
+import json
+import logging
+import argparse
+from time import time
+from multiprocessing import Pool
+from tabulate import tabulate
+import tracing
+from index import Index
+from verify import chunks, matches, prepare
+from search import ALGORITHMS, build_query, required_literals
+from reparser.regex_frontend import parse
+
+# Batch search: many regexes over the same index in one run.  All the
+# trigram queries are evaluated together, so a posting list shared by
+# several queries is decoded once.  The candidates are then grouped by
+# file, and each file is read once and searched for every pattern it is a
+# candidate of, instead of once per pattern.
+#
+# The patterns file holds one regex per line; blank lines are skipped.
+
+# compiled patterns and their prefilters in the pool worker processes, set by init_worker
+worker_patterns = None
+
+
+def read_patterns(filename):
+    with open(filename) as f:
+        return [line.rstrip("\n") for line in f if line.strip()]
+
+
+def compile_patterns(patterns, algo="gcs", jobs=1):
+    """
+    compile_patterns returns the (regex, prefilter) to search files with and
+    the trigram query of each pattern, or an error message if re can't
+    compile it.
+    """
+    compiled = []
+    for pattern in patterns:
+        try:
+            regex = re.compile(pattern)
+        except re.error as e:
+            compiled.append(str(e))
+            continue
+        tree = parse(pattern)
+        query = build_query(algo, pattern, tree, jobs)
+        regex, _, prefilter = prepare(regex, None, required_literals(tree))
+        compiled.append((regex, prefilter, query))
+    return compiled
+
+
+def search_file(patterns, filename, wanted):
+    """
+    search_file reads filename once and returns the indexes in wanted of
+    the patterns, (regex, prefilter) pairs, that match its contents.
+    """
+    try:
+        with tracing.span("read"), open(filename, 'r', errors='surrogateescape') as f:
+            tracing.count("files_opened")
+            tracing.count("bytes_read", os.fstat(f.fileno()).st_size)
+            data = f.read()
+    except OSError:
+        tracing.count("read_errors")
+        return []
+    with tracing.span("regex"):
+        return [i for i in wanted if matches(patterns[i][0], data, patterns[i][1])]
+
+
+def init_worker(patterns):
+    global worker_patterns
+    worker_patterns = patterns
+
+
+def search_worker(chunk):
+    return [(fileid, search_file(worker_patterns, filename, wanted)) for fileid, filename, wanted in chunk]
+
+
+def run(index, patterns, algo="gcs", jobs=1, chunk_size=64):
+    """
+    run searches index for every pattern and returns a result per pattern:
+    its candidate and matching files, or its error, and a summary of the
+    file reads and posting list decodes the batch saved.
+    """
+    st = time()
+    compiled = compile_patterns(patterns, algo, jobs)
+    valid = [i for i, c in enumerate(compiled) if not isinstance(c, str)]
+    logging.info("built %d queries in %s", len(valid), str(time() - st))
+
+    # Trace the evaluation to count the posting lists decoded and reused,
+    # passing the trace on to the caller's tracer.
+    tracer = tracing.Tracer()
+    with tracing.using(tracer):
+        candids = dict(zip(valid, index.get_candidate_fileids_batch([compiled[i][2] for i in valid])))
+    tracing.get_tracer().merge(tracer.report())
+    counters = tracer.report()["counters"]
+    wanted = {}
+    for i, candid in candids.items():
+        for fileid in candid:
+            wanted.setdefault(fileid, []).append(i)
+    logging.info("evaluated %d queries in %s", len(valid), str(time() - st))
+
+    found = {i: [] for i in valid}
+    searchable = [(c[0], c[1]) if not isinstance(c, str) else None for c in compiled]
+    todo = [(fileid, index.files[fileid], wanted[fileid]) for fileid in sorted(wanted)]
+    if jobs > 1:
+        with Pool(jobs, initializer=init_worker, initargs=(searchable,)) as pool:
+            results = [res for chunk in pool.imap(search_worker, chunks(todo, chunk_size)) for res in chunk]
+    else:
+        results = [(fileid, search_file(searchable, filename, pats)) for fileid, filename, pats in todo]
+    for fileid, matched in results:
+        for i in matched:
+            found[i].append(index.files[fileid])
+
+    results = []
+    for i, pattern in enumerate(patterns):
+        if isinstance(compiled[i], str):
+            results.append({"pattern": pattern, "error": compiled[i]})
+            continue
+        results.append({"pattern": pattern, "query": str(compiled[i][2]), "candidates": len(candids[i]),
+                        "matches": found[i]})
+    separate = sum(len(candid) for candid in candids.values())
+    decoded = counters.get("posting_lists", 0)
+    shared = counters.get("posting_lists_shared", 0)
+    summary = {"patterns": len(patterns), "errors": len(patterns) - len(valid), "files_read": len(todo),
+               "separate_reads": separate, "reads_saved": separate - len(todo), "posting_lists_decoded": decoded,
+               "posting_lists_shared": shared, "seconds": time() - st}
+    return results, summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("patterns", help="file of regexes, one per line")
+    parser.add_argument("-a", "--algo", help="algorithm building the trigram queries", default="gcs",
+                        choices=list(ALGORITHMS))
+    parser.add_argument("-j", "--jobs", help="number of processes used to search the candidate files", type=int,
+                        default=1)
+    parser.add_argument("--skip-ratio", help="don't intersect trigrams found in more than this fraction of the files",
+                        type=float, default=None)
+    parser.add_argument("-s", "--show", help="print the matching files of each pattern", action="store_true")
+    parser.add_argument("--json", help="write the results and the summary to this file as JSON", default=None)
+    logging.basicConfig(level="INFO")
+    args = parser.parse_args()
+    index = Index(skip_ratio=args.skip_ratio)
+    patterns = read_patterns(args.patterns)
+    results, summary = run(index, patterns, args.algo, args.jobs)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"results": results, "summary": summary}, f, indent=2)
+    rows = []
+    for res in results:
+        if "error" in res:
+            rows.append([res["pattern"], "error: " + res["error"], ""])
+        else:
+            rows.append([res["pattern"], res["candidates"], len(res["matches"])])
+    print(tabulate(rows, headers=["Pattern", "Candidates", "Matches"], tablefmt="orgtbl"))
+    if args.show:
+        for res in results:
+            for filename in res.get("matches", []):
+                print("%s:%s" % (res["pattern"], filename))
+    logging.info("%d files read instead of %d (%d saved), %d posting lists decoded, %d reused, in %s",
+                 summary["files_read"], summary["separate_reads"], summary["reads_saved"],
+                 summary["posting_lists_decoded"], summary["posting_lists_shared"], str(summary["seconds"]))
@@ -0,0 +1,256 @@
+import os
+import re
+import json
+import logging
+import argparse
+from math import ceil
+from statistics import median
+from time import perf_counter
+from tabulate import tabulate
+import corpus
+from index import Index
+from verify import verify
+from search import ALGORITHMS, build_query, required_literals
+from requery import xgr
+from reparser import regex_frontend
+from reparser.regex_frontend import parse
+
+# In-process benchmark of the query algorithms.  The index is opened once;
+# each algorithm then runs every regex warmup times unmeasured and repeat
+# times measured, timing each stage of a search separately:
+#
+#   parse    the regex into its tree
+#   query    construction of the trigram query
+#   lookup   evaluation of the query over the index into candidate files
+#   verify   the full regex search over the candidates
+#
+# Parse trees and xeger queries are memoized; the caches are cleared before
+# every run so the stages are timed cold.
+
+# The regexes csearch.py --test used to run.
+REGEXES = ["a(b+|c+)d", "(abc|cba)def", "abc+de", "ab(cd)*ef", "def|lambda", "a*(bcd|efg)",
+           r"(a|b|c)+@(a|b|c)+(\.(a|b|c))+"]
+STAGES = ["parse", "query", "lookup", "verify"]
+# Regexes for the synthetic corpus of corpus.py.
+SCALE_REGEXES = [r"def \w+\(self, \w+", "lambda", r'"(error|warning) [a-z]+_', r"return None", r"import (os|sys)"]
+
+
+def percentile(values, p):
+    """
+    percentile returns the nearest rank p-th percentile of values.
+    """
+    values = sorted(values)
+    return values[max(ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def run_once(index, algo, regex, compiled_regex, jobs):
+    """
+    run_once searches for regex with algo and returns the seconds taken
+    by each stage, the number of candidate files and the matching files.
+    """
+    regex_frontend.parse_cached.cache_clear()
+    xgr.cache.clear()
+    times = {}
+    st = perf_counter()
+    tree = parse(regex)
+    times["parse"] = perf_counter() - st
+
+    st = perf_counter()
+    query = build_query(algo, regex, tree, jobs)
+    times["query"] = perf_counter() - st
+
+    st = perf_counter()
+    candid = index.get_candidate_fileids(query)
+    times["lookup"] = perf_counter() - st
+
+    st = perf_counter()
+    matched, _ = verify(compiled_regex, index.get_filenames(candid), jobs, literals=required_literals(tree))
+    times["verify"] = perf_counter() - st
+    return times, len(candid), matched
+
+
+def measure(index, algo, regex, warmup=1, repeat=5, jobs=1):
+    """
+    measure returns the benchmark result of algo on regex: the median and
+    95th percentile of the seconds taken by each stage and in total over
+    repeat runs, the candidate and matching files, the fraction of the
+    files that are candidates and the fraction of the candidates that
+    don't match (the false positive rate).
+    """
+    compiled_regex = re.compile(regex)
+    runs = []
+    for i in range(warmup + repeat):
+        times, ncandid, matched = run_once(index, algo, regex, compiled_regex, jobs)
+        if i >= warmup:
+            times["total"] = sum(times.values())
+            runs.append(times)
+    nfiles = index.get_filecount()
+    result = {"algo": algo, "regex": regex, "candidates": ncandid, "matches": len(matched),
+              "candidate_ratio": ncandid / nfiles if nfiles else 0.0,
+              "false_positive_rate": (ncandid - len(matched)) / ncandid if ncandid else 0.0}
+    for stage in STAGES + ["total"]:
+        samples = [times[stage] for times in runs]
+        result[stage] = {"median": median(samples), "p95": percentile(samples, 95)}
+    return result, set(matched)
+
+
+def run(regexes=None, algos=None, warmup=1, repeat=5, jobs=1, skip_ratio=None):
+    """
+    run benchmarks algos (all of them by default) on regexes (REGEXES by
+    default) and returns the list of results, see measure.  If bruteforce
+    is benchmarked, each result also counts the matching files its
+    algorithm missed.
+    """
+    regexes = regexes or REGEXES
+    algos = algos or list(ALGORITHMS)
+    index = Index(skip_ratio=skip_ratio)
+    results = []
+    # Per query logging would dominate the timings.
+    logging.disable(logging.INFO)
+    try:
+        for regex in regexes:
+            found = {}
+            for algo in algos:
+                result, found[algo] = measure(index, algo, regex, warmup, repeat, jobs)
+                results.append(result)
+            if "bruteforce" in found:
+                for result in results[-len(algos):]:
+                    result["missed"] = len(found["bruteforce"] - found[result["algo"]])
+    finally:
+        logging.disable(logging.NOTSET)
+    return results
+
+
+def scale(sizes, root, regexes=None, algo="gcs", warmup=1, repeat=5, jobs=1, workers=1, seed=1, skip_ratio=None):
+    """
+    scale generates a synthetic corpus of each size (a number of files)
+    under root, indexes it, and returns for each size its index build time,
+    index size, load time and the latency of algo on regexes (SCALE_REGEXES
+    by default): the mean over the regexes of the median and p95 totals.
+    Each corpus is indexed to its own index file, next to its files.
+    """
+    regexes = regexes or SCALE_REGEXES
+    results = []
+    for n in sizes:
+        directory = os.path.join(root, str(n))
+        nbytes = corpus.generate(directory, n, seed, workers=workers)
+        index_file = os.path.join(root, "%d.idx" % n)
+        st = perf_counter()
+        Index(directory, workers, index_file=index_file)
+        build = perf_counter() - st
+        st = perf_counter()
+        index = Index(skip_ratio=skip_ratio, index_file=index_file)
+        load = perf_counter() - st
+        logging.disable(logging.INFO)
+        try:
+            latencies = [measure(index, algo, regex, warmup, repeat, jobs)[0] for regex in regexes]
+        finally:
+            logging.disable(logging.NOTSET)
+        results.append({"files": n, "bytes": nbytes, "build": build, "index_bytes": os.path.getsize(index_file),
+                        "load": load, "algo": algo,
+                        "median": sum(r["total"]["median"] for r in latencies) / len(latencies),
+                        "p95": sum(r["total"]["p95"] for r in latencies) / len(latencies),
+                        "candidate_ratio": sum(r["candidate_ratio"] for r in latencies) / len(latencies),
+                        "queries": latencies})
+    return results
+
+
+def scale_table(results):
+    """
+    scale_table returns a table of the results of scale, one row per corpus size.
+    """
+    rows = [[r["files"], "%.1f" % (r["bytes"] / 2 ** 20), "%.2f" % r["build"], "%.1f" % (r["index_bytes"] / 2 ** 20),
+             "%.3f" % (1000 * r["load"]), "%.3f" % (1000 * r["median"]), "%.3f" % (1000 * r["p95"]),
+             "%.2f %%" % (100 * r["candidate_ratio"])] for r in results]
+    headers = ["Files", "Corpus MB", "Build s", "Index MB", "Load ms", "Query ms", "p95 query ms", "Candidates"]
+    return tabulate(rows, headers=headers, tablefmt="orgtbl")
+
+
+def plot(results, filename):
+    """
+    plot draws the build time, index size, load time and query latency
+    of the results of scale against the corpus size into filename.
+    It needs matplotlib, which is not otherwise a dependency.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    files = [r["files"] for r in results]
+    series = [("index build time (s)", [r["build"] for r in results]),
+              ("index size (MB)", [r["index_bytes"] / 2 ** 20 for r in results]),
+              ("index load time (ms)", [1000 * r["load"] for r in results]),
+              ("%s query latency (ms)" % results[0]["algo"], [1000 * r["median"] for r in results])]
+    fig, axes = plt.subplots(2, 2, figsize=(10, 8))
+    for ax, (title, values) in zip(axes.flat, series):
+        ax.loglog(files, values, marker="o")
+        ax.set_title(title)
+        ax.set_xlabel("files")
+    axes.flat[-1].loglog(files, [1000 * r["p95"] for r in results], marker="o", linestyle="--", label="p95")
+    axes.flat[-1].legend()
+    fig.tight_layout()
+    fig.savefig(filename)
+
+
+def table(results):
+    """
+    table returns a table of the results averaged over the regexes of each algorithm.
+    Times are the mean over the regexes of the median, in milliseconds.
+    """
+    algos = list(dict.fromkeys(result["algo"] for result in results))
+    rows = []
+    for algo in algos:
+        rs = [result for result in results if result["algo"] == algo]
+
+        def mean(f):
+            return sum(f(r) for r in rs) / len(rs)
+
+        rows.append([algo, "%.2f %%" % (100 * mean(lambda r: r["candidate_ratio"])),
+                     "%.2f %%" % (100 * mean(lambda r: r["false_positive_rate"]))] +
+                    ["%.3f" % (1000 * mean(lambda r: r[stage]["median"])) for stage in STAGES + ["total"]] +
+                    ["%.3f" % (1000 * mean(lambda r: r["total"]["p95"])), sum(r["matches"] for r in rs),
+                     sum(r.get("missed", 0) for r in rs)])
+    headers = ["Algorithm", "Candidates", "False positives"] + ["%s ms" % stage for stage in STAGES + ["total"]] + \
+              ["p95 total ms", "Found in", "Missed"]
+    return tabulate(rows, headers=headers, tablefmt="orgtbl")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("regex", help="regexes to benchmark, the csearch.py --test ones by default", nargs="*")
+    parser.add_argument("-a", "--algos", help="comma separated algorithms to benchmark, all by default", default=None)
+    parser.add_argument("-n", "--repeat", help="measured runs of each regex", type=int, default=5)
+    parser.add_argument("--warmup", help="unmeasured runs of each regex before the measured ones", type=int, default=1)
+    parser.add_argument("-j", "--jobs", help="number of processes used to verify candidate files", type=int, default=1)
+    parser.add_argument("--skip-ratio", help="don't intersect trigrams found in more than this fraction of the files",
+                        type=float, default=None)
+    parser.add_argument("--json", help="write the results to this file as JSON", default=None)
+    parser.add_argument("--scale", help="comma separated corpus sizes: generate a synthetic corpus of each number "
+                                        "of files, index it and measure, instead of using index.idx", default=None)
+    parser.add_argument("--corpus", help="directory of the synthetic corpora and their indexes", default="corpus")
+    parser.add_argument("-w", "--workers", help="number of processes generating and indexing a corpus", type=int,
+                        default=1)
+    parser.add_argument("--seed", help="seed of the synthetic corpora", type=int, default=1)
+    parser.add_argument("--plot", help="with --scale, plot the results to this image file (needs matplotlib)",
+                        default=None)
+    logging.basicConfig(level="INFO")
+    args = parser.parse_args()
+    algos = args.algos.split(",") if args.algos else None
+    if algos and not set(algos) <= set(ALGORITHMS):
+        parser.error("unknown algorithm in %s" % args.algos)
+    if args.scale:
+        if algos and len(algos) > 1:
+            parser.error("--scale measures a single algorithm")
+        sizes = [int(n) for n in args.scale.split(",")]
+        results = scale(sizes, args.corpus, args.regex, algos[0] if algos else "gcs", args.warmup, args.repeat,
+                        args.jobs, args.workers, args.seed, args.skip_ratio)
+    else:
+        results = run(args.regex, algos, args.warmup, args.repeat, args.jobs, args.skip_ratio)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.scale:
+        print(scale_table(results))
+        if args.plot:
+            plot(results, args.plot)
+    else:
+        print(table(results))
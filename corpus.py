@@ -0,0 +1,179 @@
+import os
+import random
+import logging
+import argparse
+from time import time
+from functools import partial
+from itertools import accumulate
+from multiprocessing import Pool
+
+# Synthetic source corpus for scale benchmarks.  The files look like
+# Python: functions and classes made of keywords, identifiers, string
+# literals, numbers and comments.  Identifiers are drawn from a vocabulary
+# with Zipf distributed frequencies, so a few trigrams are in almost every
+# file and most are rare, as in real code; zipf sets the skew.
+#
+# Generation is deterministic: the vocabulary comes from seed, and file i
+# from seed and i alone.  So the first n files of a corpus are the same
+# whatever its size, and generating in parallel gives the same files.
+#
+# Files are written as root/DDDD/NNNNNNN.py, FILES_PER_DIR to a directory.
+
+FILES_PER_DIR = 1000
+
+KEYWORDS = ["def", "class", "return", "if", "elif", "else", "for", "while", "in", "not", "and", "or", "is",
+            "None", "True", "False", "import", "from", "try", "except", "raise", "with", "as", "lambda",
+            "yield", "pass", "break", "continue"]
+SYLLABLES = ["ab", "al", "an", "ar", "ba", "be", "ca", "co", "da", "de", "di", "do", "el", "en", "er", "ex", "fa",
+             "fi", "ga", "ge", "ha", "he", "id", "in", "is", "ka", "la", "le", "li", "lo", "ma", "me", "mi", "mo",
+             "na", "ne", "no", "nu", "ob", "on", "or", "pa", "pe", "po", "qu", "ra", "re", "ri", "ro", "sa", "se",
+             "si", "so", "ta", "te", "ti", "to", "un", "ur", "va", "ve", "vi", "xa", "yo", "za", "zu"]
+MESSAGES = ["error", "warning", "invalid", "missing", "failed to", "cannot", "unexpected", "not found", "timeout",
+            "done", "retrying", "skipping"]
+MODULES = ["os", "sys", "re", "json", "time", "logging", "random", "collections", "itertools", "functools"]
+
+
+class Vocabulary:
+    """
+    Vocabulary holds the identifiers of a corpus and their Zipf weights.
+    """
+
+    def __init__(self, seed=1, size=5000, zipf=1.1):
+        rng = random.Random(seed)
+        words = set()
+        while len(words) < size:
+            word = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4)))
+            if rng.random() < 0.3:
+                word += "_" + "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 3)))
+            words.add(word)
+        self.words = sorted(words)
+        rng.shuffle(self.words)
+        self.weights = list(accumulate(1 / (rank + 1) ** zipf for rank in range(size)))
+
+    def identifier(self, rng):
+        return rng.choices(self.words, cum_weights=self.weights)[0]
+
+
+def expression(rng, vocab, depth=0):
+    r = rng.random()
+    if depth > 1 or r < 0.35:
+        return vocab.identifier(rng)
+    if r < 0.5:
+        return str(rng.randint(0, 1000))
+    if r < 0.65:
+        return '"%s %s"' % (rng.choice(MESSAGES), vocab.identifier(rng))
+    if r < 0.8:
+        return "%s.%s" % (vocab.identifier(rng), vocab.identifier(rng))
+    if r < 0.9:
+        return "%s %s %s" % (expression(rng, vocab, depth + 1), rng.choice(["+", "-", "*", "==", "<", "and", "or"]),
+                             expression(rng, vocab, depth + 1))
+    args = ", ".join(expression(rng, vocab, depth + 1) for _ in range(rng.randint(0, 3)))
+    return "%s(%s)" % (vocab.identifier(rng), args)
+
+
+def statement(rng, vocab, indent):
+    pad = "    " * indent
+    r = rng.random()
+    if r < 0.4:
+        return ["%s%s = %s" % (pad, vocab.identifier(rng), expression(rng, vocab))]
+    if r < 0.55:
+        return ["%sreturn %s" % (pad, expression(rng, vocab))]
+    if r < 0.65:
+        return ["%s# %s %s" % (pad, rng.choice(MESSAGES), " ".join(vocab.identifier(rng) for _ in range(3)))]
+    if r < 0.75:
+        return ['%sraise ValueError("%s %s")' % (pad, rng.choice(MESSAGES), vocab.identifier(rng))]
+    if indent > 2:
+        return ["%s%s(%s)" % (pad, vocab.identifier(rng), expression(rng, vocab))]
+    if r < 0.9:
+        head = "%sif %s:" % (pad, expression(rng, vocab))
+    else:
+        head = "%sfor %s in %s:" % (pad, vocab.identifier(rng), expression(rng, vocab))
+    lines = [head]
+    for _ in range(rng.randint(1, 3)):
+        lines.extend(statement(rng, vocab, indent + 1))
+    return lines
+
+
+def function(rng, vocab, indent=0, method=False):
+    pad = "    " * indent
+    params = [vocab.identifier(rng) for _ in range(rng.randint(0, 3))]
+    if method:
+        params.insert(0, "self")
+    lines = ["%sdef %s(%s):" % (pad, vocab.identifier(rng), ", ".join(params))]
+    if rng.random() < 0.3:
+        lines.append('%s    """%s %s."""' % (pad, vocab.identifier(rng), rng.choice(MESSAGES)))
+    for _ in range(rng.randint(1, 6)):
+        lines.extend(statement(rng, vocab, indent + 1))
+    return lines
+
+
+def source(rng, vocab, lines):
+    """
+    source returns the text of a file of about lines lines.
+    """
+    out = ["import %s" % m for m in rng.sample(MODULES, rng.randint(1, 4))]
+    out.append("")
+    while len(out) < lines:
+        if rng.random() < 0.2:
+            out.append("class %s(%s):" % (vocab.identifier(rng), vocab.identifier(rng)))
+            for _ in range(rng.randint(1, 3)):
+                out.extend(function(rng, vocab, 1, True))
+                out.append("")
+        else:
+            out.extend(function(rng, vocab))
+        out.append("")
+    return "\n".join(out) + "\n"
+
+
+def file_path(root, i):
+    return os.path.join(root, "%04d" % (i // FILES_PER_DIR), "%07d.py" % i)
+
+
+def write_files(ids, root, vocab, seed, lines):
+    """
+    write_files writes the files with the given ids and returns the number of bytes written.
+    """
+    nbytes = 0
+    for i in ids:
+        rng = random.Random("%d:%d" % (seed, i))
+        data = source(rng, vocab, rng.randint(lines // 2, lines * 3 // 2)).encode()
+        path = file_path(root, i)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fp:
+            fp.write(data)
+        nbytes += len(data)
+    return nbytes
+
+
+def generate(root, nfiles, seed=1, lines=40, vocab_size=5000, zipf=1.1, workers=1):
+    """
+    generate writes a corpus of nfiles files of about lines lines each
+    under root and returns its size in bytes.
+    """
+    logging.info("generating %d files in %s", nfiles, root)
+    st = time()
+    vocab = Vocabulary(seed, vocab_size, zipf)
+    write = partial(write_files, root=root, vocab=vocab, seed=seed, lines=lines)
+    shards = [range(i, min(i + FILES_PER_DIR, nfiles)) for i in range(0, nfiles, FILES_PER_DIR)]
+    if workers > 1:
+        with Pool(workers) as pool:
+            nbytes = sum(pool.imap_unordered(write, shards))
+    else:
+        nbytes = sum(map(write, shards))
+    logging.info("generated %d files, %.1f MB in %s", nfiles, nbytes / 2 ** 20, str(time() - st))
+    return nbytes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="directory to write the corpus to")
+    parser.add_argument("-n", "--files", help="number of files", type=int, default=1000)
+    parser.add_argument("-l", "--lines", help="average number of lines of a file", type=int, default=40)
+    parser.add_argument("-s", "--seed", help="seed of the corpus", type=int, default=1)
+    parser.add_argument("--vocabulary", help="number of distinct identifiers", type=int, default=5000)
+    parser.add_argument("--zipf", help="exponent of the Zipf distribution of identifiers, higher is more skewed",
+                        type=float, default=1.1)
+    parser.add_argument("-w", "--workers", help="number of processes writing files", type=int, default=1)
+    logging.basicConfig(level="INFO")
+    args = parser.parse_args()
+    generate(args.directory, args.files, args.seed, args.lines, args.vocabulary, args.zipf, args.workers)
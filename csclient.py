@@ -0,0 +1,33 @@
+import sys
+import json
+import socket
+import argparse
+
+# Thin client of csearchd.py: sends one query over the unix socket and
+# prints the matching files as they arrive.
+
+parser = argparse.ArgumentParser()
+parser.add_argument("regex", help="regex to search")
+parser.add_argument("-a", "--algo", help="type of algorithm to be used", default="gcs")
+parser.add_argument("-l", "--limit", help="stop after this many matching files", type=int, default=None)
+parser.add_argument("--socket", help="unix socket of the daemon", default="csearch.sock")
+args = parser.parse_args()
+
+sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+try:
+    sock.connect(args.socket)
+except OSError as e:
+    sys.exit("can't connect to %s: %s" % (args.socket, e))
+request = {"regex": args.regex, "algo": args.algo, "limit": args.limit}
+sock.sendall(json.dumps(request).encode() + b"\n")
+for line in sock.makefile("rb"):
+    msg = json.loads(line)
+    if "file" in msg:
+        print(msg["file"])
+    elif "error" in msg:
+        sys.exit(msg["error"])
+    else:
+        print("%d matches in %d candidate files, %.3f seconds" % (msg["matches"], msg["candidates"], msg["seconds"]),
+              file=sys.stderr)
+        break
+sock.close()
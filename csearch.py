@@ -1,31 +1,90 @@
 import os
 import re
 import sys
-import mmap
+import json
+import atexit
 import logging
 import argparse
+import cProfile
 from time import time
 from tabulate import tabulate
-import pickle
-from copy import deepcopy
-from query import allQuery
-from requery.gcs import regexpQuery
-from requery.reset import regexp_query
-from requery.xgr import xegerQuery
-from requery.free import freeQuery
+import benchmark
+import tracing
 from index import Index
-from reparser.regex_parser import parse
+from verify import iter_matches, single_line, verify
+from query import allQuery
+from search import ALGORITHMS, auto_query, build_query, candidate_files, required_literals
+from reparser.regex_frontend import parse
 
 parser = argparse.ArgumentParser()
-parser.add_argument("-a", "--algo", help="type of algorithm to be used", default="empty")
+parser.add_argument("-a", "--algo", help="type of algorithm to be used: bruteforce, gcs, reset, xeger, free, auto "
+                                        "(the most selective of gcs, free and reset) or demo", default="empty")
 parser.add_argument("regex", help="regex to search", default="empty")
 parser.add_argument("-i", "--index", help="build a new index file", action="store_true")
 parser.add_argument("-d", "--directory", help="name of the directory", default='empty')
+parser.add_argument("-w", "--workers", help="number of processes used to build the index", type=int, default=1)
+parser.add_argument("-u", "--update", help="update the index with the changes in the directory", action="store_true")
+parser.add_argument("--block-size", help="with -i, also record which blocks of about this many bytes of a file hold "
+                                          "each trigram, so verification only reads the blocks that can match",
+                    type=int, default=None)
+parser.add_argument("--max-file-size", help="with -i or -u, don't index files of more than this many bytes", type=int,
+                    default=None)
+parser.add_argument("--memory-budget", help="with -i, keep the posting lists in memory under about this many MiB, "
+                                             "spilling sorted runs next to the index and merging them at the end; "
+                                             "with -w, the shards in flight take up to about as much again",
+                    type=int, default=None)
+parser.add_argument("--hash", help="store content hashes to detect changed files", action="store_true")
+parser.add_argument("--compact", help="purge deleted files from the index", action="store_true")
+parser.add_argument("--skip-ratio", help="don't intersect trigrams found in more than this fraction of the files",
+                    type=float, default=None)
+parser.add_argument("-j", "--jobs", help="number of processes used to verify candidate files and draw xeger samples",
+                    type=int, default=1)
+parser.add_argument("-m", "--mmap-threshold", help="search files as bytes, mmapping those of at least this many bytes, "
+                                                  "if the regex matches the same as bytes", type=int, default=None)
+parser.add_argument("--no-prefilter", help="don't check required literals before running the regex",
+                    action="store_true")
 parser.add_argument("-s", "--show", help="show the candidate documents", action="store_true")
-parser.add_argument("-t", "--test", help="Test", action="store_true")
+parser.add_argument("-n", "--lines", help="print the matching lines as file:line:column:text as they are found",
+                    action="store_true")
+parser.add_argument("-C", "--context", help="with the matching lines, print this many lines around them", type=int,
+                    default=0)
+parser.add_argument("--max-count", help="print at most this many matching lines of a file", type=int, default=None)
+parser.add_argument("--limit", help="stop after this many matching lines, reading no more candidate files",
+                    type=int, default=None)
+parser.add_argument("-t", "--test", help="benchmark the algorithms on a fixed set of regexes, see benchmark.py",
+                    action="store_true")
+parser.add_argument("--profile", help="trace the stages of the run and write the spans and counters as JSON "
+                                       "to this file, - for stdout", nargs="?", const="-", default=None)
+parser.add_argument("--cprofile", help="also run under cProfile, writing the stats to this file", default=None)
 logging.basicConfig(level="INFO")
 args = parser.parse_args()
 reg = args.regex
+if args.block_size is not None and args.block_size < 64:
+    parser.error("--block-size must be at least 64")
+
+
+def write_profile(tracer, profiler):
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.cprofile)
+        logging.info("cProfile stats written to %s", args.cprofile)
+    if tracer is not None:
+        report = json.dumps(tracer.report(), indent=2)
+        if args.profile == "-":
+            print(report)
+        else:
+            with open(args.profile, "w") as f:
+                f.write(report + "\n")
+
+
+if args.profile or args.cprofile:
+    # Written on exit, which may come from any of the quit()s below.
+    tracer = tracing.Tracer() if args.profile else None
+    tracing.set_tracer(tracer)
+    profiler = cProfile.Profile() if args.cprofile else None
+    if profiler is not None:
+        profiler.enable()
+    atexit.register(write_profile, tracer, profiler)
 
 try:
     compiled_regex = re.compile(reg)
@@ -33,7 +92,13 @@ except:
     logging.info("Invalid regular expression")
     quit()
 
-regex_tree = parse(reg)
+try:
+    with tracing.span("parse"):
+        regex_tree = parse(reg)
+    literals = required_literals(regex_tree)
+except RecursionError:
+    # Too deeply nested to analyze; the query below falls back to every file.
+    regex_tree = literals = None
 flag = 1
 # index = Index()
 logging.info("constructing trigram query")
@@ -42,19 +107,47 @@ logging.info("constructing trigram query")
 def full_regex_search(file_names):
     logging.info("full regular expression search starting")
     st = time()
-    ctr = 0
-    for filename in file_names:
-        try:
-            with open(filename, 'r+') as f:
-                mo = compiled_regex.search(f.read())
-                if mo:
-                    ctr += 1
-                    if args.show:
-                        logging.info(" Found in -  %s", filename)
-        except:
-            pass
+    with tracing.span("verify"):
+        matched, workers = verify(compiled_regex, file_names, args.jobs, mmap_threshold=args.mmap_threshold,
+                                  literals=None if args.no_prefilter else literals)
+    if args.show:
+        for filename in matched:
+            logging.info(" Found in -  %s", filename)
+    if args.jobs > 1:
+        for pid, (nfiles, nmatched, dur, _) in sorted(workers.items()):
+            logging.info("worker %d searched %d files, %d matches in %s", pid, nfiles, nmatched, str(dur))
+    if literals and not args.no_prefilter:
+        logging.info("prefilter on %s rejected %d of %d files", literals, sum(w[3] for w in workers.values()),
+                     sum(w[0] for w in workers.values()))
     logging.info("full regular expression search took %s", str(time() - st))
-    return ctr, time() - st
+    return len(matched), time() - st
+
+
+def stream_regex_search(file_names):
+    """
+    stream_regex_search prints the matching lines of the files as they are
+    found and returns the number of matching files.  It searches in this
+    process, one file at a time, to stop reading files at --limit.
+    """
+    logging.info("streaming regular expression search starting")
+    st = time()
+    files = set()
+    nlines = 0
+    with tracing.span("verify"):
+        for m in iter_matches(compiled_regex, file_names, args.mmap_threshold,
+                              None if args.no_prefilter else literals, args.context, args.max_count, args.limit):
+            if args.context and nlines:
+                print("--")
+            for i, line in enumerate(m.before):
+                print("%s-%d-%s" % (m.file, m.line - len(m.before) + i, line))
+            print("%s:%d:%d:%s" % (m.file, m.line, m.column, m.text))
+            last = m.line + m.text.count("\n")
+            for i, line in enumerate(m.after):
+                print("%s-%d-%s" % (m.file, last + 1 + i, line))
+            files.add(m.file)
+            nlines += 1
+    logging.info("%d matching lines, streaming search took %s", nlines, str(time() - st))
+    return len(files), time() - st
 
 
 if args.index:
@@ -63,31 +156,26 @@ if args.index:
         quit()
     else:
         if os.path.exists(args.directory):
-            index = Index(args.directory)
+            index = Index(args.directory, args.workers, args.hash, block_size=args.block_size,
+                          max_file_size=args.max_file_size,
+                          memory_budget=args.memory_budget and args.memory_budget * 2 ** 20)
         else:
             logging.info('No such file exists')
             quit()
 
-if args.test:
-    try:
-        os.system("rm my.pkl")
-    except:
-        pass
-
-    regexs = ["a(b+|c+)d", "(abc|cba)def", "abc+de", "ab(cd)*ef", "def|lambda", "a*(bcd|efg)",
-              "(a|b|c)+@(a|b|c)+(\.(a|b|c))+"]
-
-    for i in range(len(regexs)):
-        os.system("python3 csearch.py -a demo " + '"' + regexs[i] + '"')
-        print(i + 1, "done")
-    with open("my.pkl", 'rb') as f:
-        x = pickle.load(f)
+if args.update:
+    if not os.path.exists(args.directory):
+        logging.info('Please read usage --help')
+        quit()
+    index = Index(max_file_size=args.max_file_size)
+    index.update(args.directory, args.hash)
 
-    for i in range(1, 4):
-        for j in range(5):
-            x[j][i] /= len(regexs)
+if args.compact:
+    index = Index()
+    index.compact()
 
-    print(tabulate(x, headers=['Algorithm', 'Space', 'Query Time', 'Search Time', 'Found in'], tablefmt='orgtbl'))
+if args.test:
+    print(benchmark.table(benchmark.run(jobs=args.jobs, skip_ratio=args.skip_ratio)))
     quit()
 
 
@@ -95,60 +183,47 @@ def demo():
     logging.info("Comparison of various codesearch algorithms\n")
     lis = []
     algo = ['Brute Force', 'Google Code Search', 'RESET', 'XEGER', 'FREE']
-    func = [deepcopy, allQuery, regexpQuery, regex_tree, regexp_query, regex_tree, xegerQuery, args.regex, freeQuery,
-            regex_tree]
+    keys = ['bruteforce', 'gcs', 'reset', 'xeger', 'free']
     for i in range(5):
         try:
             lis.append([algo[i]])
             st = time()
-            query = func[2 * i](func[2 * i + 1])
+            # Each algorithm gets its own copy of the cached parse tree.
+            query = build_query(keys[i], args.regex, jobs=args.jobs)
             logging.info(" query generated for %s %s", algo[i], query)
             dur_q = time() - st
-            index = Index()
+            index = Index(skip_ratio=args.skip_ratio)
             tot = index.get_filecount()
             logging.info("%s identified %d candidate files", algo[i], tot)
             candid = index.get_candidate_fileids(query)
             file_names = index.get_filenames(candid)
-            ctr, dur_s = full_regex_search(file_names, args.regex)
+            ctr, dur_s = full_regex_search(file_names)
             # print(i, len(candid), ctr)
             lis[-1].extend([str(round((len(candid) * 100) / tot, 2)) + ' %', str(round(dur_q, 5)) + ' seconds',
                             str(round(dur_s, 5)) + ' seconds', ctr])
         except Exception as e:
             pass
     print('\n')
-    test(lis)
     print(tabulate(lis, headers=['Algorithm', 'Space', 'Query Time', 'Search Time', 'Found in'], tablefmt='orgtbl'))
 
 
-def test(lis):
-    try:
-        with open('my.pkl', 'rb') as f:
-            nlis = pickle.load(f)
-    except:
-        nlis = [['Brute Force', 0, 0, 0], ['Google Code Search', 0, 0, 0], ['RESET', 0, 0, 0], ['XEGER', 0, 0, 0],
-                ['FREE', 0, 0, 0]]
-
-    for i in range(1, 4):
-        for j in range(5):
-            y = lis[j][i].split(' ')
-            nlis[j][i] += float(y[0])
-
-    with open('my.pkl', 'wb') as f:
-        pickle.dump(nlis, f)
-
-
 if args.algo == 'empty':
     print('Please read usage --help')
     quit()
 else:
-    algo_dict = {'bruteforce': [deepcopy, allQuery],
-                 'gcs': [regexpQuery, regex_tree],
-                 'reset': [regexp_query, regex_tree],
-                 'xeger': [xegerQuery, args.regex],
-                 'free': [freeQuery, regex_tree]}
     st = time()
-    if args.algo in algo_dict:
-        query = algo_dict[args.algo][0](algo_dict[args.algo][1])
+    index = None
+    if args.algo in ALGORITHMS or args.algo == 'auto':
+        try:
+            if args.algo == 'auto':
+                index = Index(skip_ratio=args.skip_ratio)
+                algo, query, estimates = auto_query(index, reg, regex_tree)
+                logging.info("auto chose %s, estimated candidates %s", algo, estimates)
+            else:
+                query = build_query(args.algo, reg, regex_tree, args.jobs)
+        except RecursionError:
+            logging.info("regular expression too deeply nested to analyze, searching every file")
+            query = allQuery
     elif args.algo == 'demo':
         demo()
         flag = 0
@@ -160,12 +235,15 @@ else:
         logging.info("%s took %s to construct trigram query", args.algo, str(dur))
         logging.info("trigram query: %s", str(query))
 
-        index = Index()
-        candid = index.get_candidate_fileids(query)
+        if index is None:
+            index = Index(skip_ratio=args.skip_ratio)
+        candid = []
+        if args.lines or args.context or args.max_count is not None or args.limit is not None:
+            ctr, x = stream_regex_search(candidate_files(index, query, candid))
+        else:
+            # Blocks hold whole lines, so they can only be searched for a regex matching within a line.
+            blocks = index.block_size is not None and single_line(compiled_regex)
+            ctr, x = full_regex_search(candidate_files(index, query, candid, blocks))
 
         logging.info("%s identified %d candidate files", args.algo, len(candid))
-
-        file_names = index.get_filenames(candid)
-
-        ctr, x = full_regex_search(file_names, args.regex)
         logging.info("%d files have substring matching %s", ctr, reg)
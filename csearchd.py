@@ -0,0 +1,203 @@
+import os
+import re
+import json
+import logging
+import argparse
+import threading
+import socketserver
+from time import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from index import Index
+from verify import search_files, single_line
+from search import ALGORITHMS, auto_query, build_query, candidate_files, required_literals
+from reparser.regex_frontend import parse
+
+# The search daemon keeps the index mapped and answers queries over a unix
+# socket and, optionally, HTTP.  A request is a JSON object
+#
+#   {"regex": "...", "algo": "gcs", "limit": 20}
+#
+# (HTTP takes the same fields as GET /search?regex=...&algo=...&limit=...).
+# The answer is streamed as JSON lines: {"file": name} for each matching
+# file as soon as it is found, then {"done": true, ...} with the counts,
+# or {"error": message}, which also ends a search that fails part way.
+
+# Query construction interns nodes in a table shared by all threads;
+# build one query at a time.
+parse_lock = threading.Lock()
+
+
+class Searcher:
+    """
+    Searcher holds the open index for the daemon.  A rewritten index
+    file is reopened on the next query; queries already running keep
+    the index they started with.
+    """
+
+    def __init__(self, index_file="index.idx", skip_ratio=None, mmap_threshold=None):
+        self.index_file = index_file
+        self.skip_ratio = skip_ratio
+        self.mmap_threshold = mmap_threshold
+        self.lock = threading.Lock()
+        self.index = None
+        self.mtime_ns = None
+        self.current()
+
+    def current(self):
+        """
+        current returns the index to run a query against, reopening it if the file changed.
+        """
+        with self.lock:
+            mtime_ns = os.stat(self.index_file).st_mtime_ns
+            if mtime_ns != self.mtime_ns:
+                logging.info("loading index %s", self.index_file)
+                self.index = Index(skip_ratio=self.skip_ratio, index_file=self.index_file)
+                self.mtime_ns = mtime_ns
+            return self.index
+
+    def answer(self, request):
+        """
+        answer yields the JSON messages of run, ending with an error
+        message if the search fails, so the client learns about it.
+        """
+        try:
+            yield from self.run(request)
+        except Exception as e:
+            logging.exception("search %r failed", request)
+            yield {"error": "search failed: %s" % e}
+
+    def run(self, request):
+        """
+        run yields the JSON messages answering a search request.
+        """
+        st = time()
+        regex = request.get("regex")
+        algo = request.get("algo", "gcs")
+        limit = request.get("limit")
+        if not isinstance(regex, str):
+            yield {"error": "missing regex"}
+            return
+        if algo not in ALGORITHMS and algo != "auto":
+            yield {"error": "unknown algorithm %s" % algo}
+            return
+        try:
+            compiled_regex = re.compile(regex)
+            limit = None if limit is None else int(limit)
+        except (re.error, ValueError) as e:
+            yield {"error": str(e)}
+            return
+        index = self.current()
+        with parse_lock:
+            tree = parse(regex)
+            literals = required_literals(tree)
+            if algo == "auto":
+                algo, query, estimates = auto_query(index, regex, tree)
+                logging.info("auto chose %s, estimated candidates %s", algo, estimates)
+            else:
+                query = build_query(algo, regex, tree)
+        candid = []
+        matches = 0
+        if limit is None or limit > 0:
+            blocks = index.block_size is not None and single_line(compiled_regex)
+            files = candidate_files(index, query, candid, blocks)
+            for filename in search_files(compiled_regex, files, self.mmap_threshold, literals):
+                matches += 1
+                yield {"file": filename}
+                if matches == limit:
+                    break
+        logging.info("%s %r: %d candidates, %d matches in %s", algo, regex, len(candid), matches, str(time() - st))
+        yield {"done": True, "algo": algo, "query": str(query), "candidates": len(candid), "matches": matches,
+               "seconds": time() - st}
+
+
+class UnixHandler(socketserver.StreamRequestHandler):
+    """
+    UnixHandler answers one JSON request per line on a unix socket connection.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                messages = iter([{"error": str(e)}])
+            else:
+                messages = self.server.searcher.answer(request)
+            for msg in messages:
+                self.wfile.write(json.dumps(msg).encode() + b"\n")
+                self.wfile.flush()
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class HTTPHandler(BaseHTTPRequestHandler):
+    """
+    HTTPHandler answers GET /search with the results as streamed JSON lines.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/search":
+            self.send_error(404)
+            return
+        request = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        for msg in self.server.searcher.answer(request):
+            self.wfile.write(json.dumps(msg).encode() + b"\n")
+            self.wfile.flush()
+
+    def log_message(self, fmt, *args):
+        logging.debug(fmt, *args)
+
+
+def serve(searcher, socket_path, port=None):
+    """
+    serve answers queries on socket_path, and on HTTP port if given, until interrupted.
+    """
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    unix_server = UnixServer(socket_path, UnixHandler)
+    unix_server.searcher = searcher
+    servers = [unix_server]
+    if port is not None:
+        http_server = ThreadingHTTPServer(("127.0.0.1", port), HTTPHandler)
+        http_server.daemon_threads = True
+        http_server.searcher = searcher
+        servers.append(http_server)
+        threading.Thread(target=http_server.serve_forever, daemon=True).start()
+        logging.info("serving HTTP on 127.0.0.1:%d", port)
+    logging.info("serving on %s", socket_path)
+    try:
+        unix_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers[1:]:
+            server.shutdown()
+        for server in servers:
+            server.server_close()
+        os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", help="unix socket to listen on", default="csearch.sock")
+    parser.add_argument("--port", help="also serve HTTP on this port of localhost", type=int, default=None)
+    parser.add_argument("--index-file", help="index file to serve", default="index.idx")
+    parser.add_argument("--skip-ratio", help="don't intersect trigrams found in more than this fraction of the files",
+                        type=float, default=None)
+    parser.add_argument("-m", "--mmap-threshold", help="search files as bytes, mmapping those of at least this many bytes",
+                        type=int, default=None)
+    logging.basicConfig(level="INFO")
+    args = parser.parse_args()
+    if not os.path.exists(args.index_file):
+        logging.error("no index %s, build one with csearch.py -i", args.index_file)
+        quit()
+    serve(Searcher(args.index_file, args.skip_ratio, args.mmap_threshold), args.socket, args.port)
@@ -0,0 +1,154 @@
+import heapq
+import os
+import shutil
+import struct
+import tempfile
+from array import array
+from itertools import groupby
+from operator import itemgetter
+from indexfile import encode_blocks
+
+# External sort of the posting lists of an index build, for corpora whose
+# postings don't fit in memory.  The build adds (trigram, file id) pairs
+# to an in-memory dict of posting lists; when that outgrows the memory
+# budget, Runs.spill writes it to a temporary file as a run sorted by
+# trigram and the build starts over with an empty dict.  At the end
+# Runs.merge k-way merges the runs, and what is left in memory, back into
+# one stream of (trigram, posting list) pairs in trigram order, which
+# write_index consumes one list at a time.
+#
+# File ids are handed out in increasing order, so every id of a run is
+# below those of the runs spilled after it: the posting list of a trigram
+# is the concatenation of its lists in the runs, in run order.
+#
+# A run is a sequence of
+#
+#   header           uint32 trigram, uint32 count
+#   file ids         count x uint32, native byte order
+#
+# Run files are only read by the process that wrote them.
+
+RUNENTRY = struct.Struct("<II")
+
+# When this many runs have been spilled they are merged into one, so the
+# final merge never has more than FAN_IN files open.
+FAN_IN = 64
+
+
+def write_run(path, items):
+    """
+    write_run writes the (trigram, file id array) pairs of items,
+    in trigram order, to a run file at path.
+    """
+    with open(path, "wb") as fp:
+        for t, fileids in items:
+            fp.write(RUNENTRY.pack(t, len(fileids)))
+            fileids.tofile(fp)
+
+
+def read_run(path):
+    """
+    read_run yields the (trigram, file id array) pairs of the run file at path.
+    """
+    with open(path, "rb") as fp:
+        while True:
+            header = fp.read(RUNENTRY.size)
+            if not header:
+                return
+            t, count = RUNENTRY.unpack(header)
+            fileids = array("I")
+            fileids.fromfile(fp, count)
+            yield t, fileids
+
+
+def merge_items(streams):
+    """
+    merge_items merges streams of (trigram, file id array) pairs sorted by
+    trigram, concatenating the arrays of a trigram in stream order.
+    """
+    for t, group in groupby(heapq.merge(*streams, key=itemgetter(0)), key=itemgetter(0)):
+        _, fileids = next(group)
+        for _, more in group:
+            fileids.extend(more)
+        yield t, fileids
+
+
+class Runs:
+    """
+    Runs holds the sorted runs spilled by an index build in a temporary
+    directory under dir.  It should be closed to delete them.
+    """
+
+    def __init__(self, dir=None):
+        self.dir = tempfile.mkdtemp(prefix="csidx-", dir=dir)
+        self.paths = []
+        # Number of runs written, merge passes included.
+        self.spilled = 0
+
+    def path(self):
+        self.spilled += 1
+        return os.path.join(self.dir, "run%06d" % self.spilled)
+
+    def spill(self, postings):
+        """
+        spill writes the trigram -> sorted file id arrays in postings as a run.
+        """
+        path = self.path()
+        write_run(path, ((t, postings[t]) for t in sorted(postings)))
+        self.paths.append(path)
+        if len(self.paths) >= FAN_IN:
+            path = self.path()
+            write_run(path, merge_items([read_run(p) for p in self.paths]))
+            for p in self.paths:
+                os.remove(p)
+            self.paths = [path]
+
+    def merge(self, postings):
+        """
+        merge yields every (trigram, posting list) pair of the runs followed
+        by postings, the ids added since the last spill, in trigram order.
+        """
+        streams = [read_run(path) for path in self.paths]
+        streams.append((t, postings[t]) for t in sorted(postings))
+        return merge_items(streams)
+
+    def close(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class BlockSpill:
+    """
+    BlockSpill stands in for the list of the block postings of the files
+    of a build, see write_index, keeping them encoded in a temporary file
+    in dir instead of in memory.  Iterating over it yields None for a
+    file in a single block, else the encoded block postings of the file.
+    """
+
+    def __init__(self, dir):
+        self.fp = open(os.path.join(dir, "blocks"), "w+b")
+        # Size of the block postings of each file in fp, 0 for None.
+        self.sizes = array("Q")
+
+    def append(self, fblocks):
+        if fblocks is None:
+            self.sizes.append(0)
+            return
+        data = bytearray()
+        encode_blocks(fblocks[0], fblocks[1], data)
+        self.sizes.append(len(data))
+        self.fp.write(data)
+
+    def extend(self, blocks):
+        for fblocks in blocks:
+            self.append(fblocks)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __iter__(self):
+        self.fp.seek(0)
+        for size in self.sizes:
+            yield self.fp.read(size) if size else None
+
+    def close(self):
+        self.fp.close()
@@ -1,112 +1,822 @@
+import hashlib
 import logging
 import os
-import pickle
+import threading
+import tracing
 from query import Query
+from plan import AndIterator, EmptyIterator, OrIterator, RangeIterator, iterate
+from indexfile import IndexReader, trigram_keys, write_index
+from extsort import BlockSpill, Runs
 from time import time
-from collections import defaultdict
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict, deque
+from functools import partial
+from multiprocessing import Pool
 
 logging.basicConfig(level="INFO")
 
 
+NOHASH = bytes(20)
+
+# A posting list is a sorted array of uint32 file ids.
+posting_list = partial(array, "I")
+
+
+def hash_file(file):
+    """
+    hash_file returns the sha1 digest of the contents of file.
+    """
+    h = hashlib.sha1()
+    with open(file, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 16), b""):
+            h.update(chunk)
+    return h.digest()
+
+
+# Files are read and tokenized CHUNK_SIZE bytes at a time.
+CHUNK_SIZE = 1 << 20
+
+# Reasons files are not indexed, counted in Index.skips.
+TOO_LARGE = "too large"
+
+
+def normalize(data):
+    # The regex runs over the file read in text mode, which
+    # translates newlines; index what it will see.
+    if b"\r" in data:
+        return data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    return data
+
+
+def pack(trigrams):
+    return {x << 16 | y << 8 | z for x, y, z in trigrams}
+
+
+class Tokenizer:
+    """
+    Tokenizer collects the byte trigrams of a file fed to it a chunk at a
+    time.  The last 2 bytes of a chunk are carried over to the next, so
+    the trigrams spanning chunks are found too.  A chunk's trigrams are
+    taken at once as the set of (byte, byte, byte) tuples zipped from three
+    shifted views of it, and only the distinct ones are packed, at the end.
+    With a block_size the trigrams of each block are collected as well:
+    a block starts at the first line after block_size - 1 bytes from the
+    start of the previous one, see indexfile.
+    """
+
+    def __init__(self, block_size=None):
+        self.block_size = block_size
+        self.trigrams = set()
+        self.carry = b""
+        # A \r ending a chunk, held back in case a \n follows.
+        self.pending = b""
+        # Offset in the file of the next chunk.
+        self.offset = 0
+        self.starts = [0]
+        self.block = set()
+        self.block_carry = b""
+        self.blocks = defaultdict(list)
+
+    def feed(self, chunk, final=False):
+        chunk = self.pending + chunk
+        self.pending = b""
+        if chunk.endswith(b"\r") and not final:
+            self.pending, chunk = b"\r", chunk[:-1]
+        data = self.carry + normalize(chunk)
+        self.trigrams.update(zip(data, data[1:], data[2:]))
+        self.carry = data[-2:]
+        if self.block_size:
+            self.split(chunk)
+        self.offset += len(chunk)
+
+    def split(self, chunk):
+        """
+        split adds the trigrams of chunk to the blocks they lie in.
+        """
+        pos = 0
+        while True:
+            i = chunk.find(b"\n", max(self.starts[-1] + self.block_size - 1 - self.offset, pos))
+            if i < 0:
+                self.add_block(chunk[pos:])
+                return
+            self.add_block(chunk[pos:i + 1])
+            self.end_block()
+            self.starts.append(self.offset + i + 1)
+            pos = i + 1
+
+    def add_block(self, part):
+        data = self.block_carry + normalize(part)
+        self.block.update(zip(data, data[1:], data[2:]))
+        self.block_carry = data[-2:]
+
+    def end_block(self):
+        k = len(self.starts) - 1
+        for t in self.block:
+            self.blocks[t].append(k)
+        self.block = set()
+        self.block_carry = b""
+
+    def finish(self):
+        """
+        finish returns the set of packed trigrams of the file and, if it
+        has more than one block, its block starts and the sorted numbers
+        of the blocks holding each packed trigram, else None.
+        """
+        self.feed(b"", True)
+        trigrams = pack(self.trigrams)
+        if not self.block_size:
+            return trigrams, None
+        if self.starts[-1] == self.offset and len(self.starts) > 1:
+            # The file ends with a newline; no empty last block.
+            self.starts.pop()
+        else:
+            self.end_block()
+        if len(self.starts) == 1:
+            return trigrams, None
+        return trigrams, (self.starts, {x << 16 | y << 8 | z: ks for (x, y, z), ks in self.blocks.items()})
+
+
+def read_trigrams(file, hash_files=False, block_size=None, chunk_size=CHUNK_SIZE):
+    """
+    read_trigrams returns the set of packed byte trigrams in file, its
+    (size, mtime_ns, sha1) metadata and, with a block_size, its blocks
+    (see Tokenizer.finish).  Trigrams are of bytes, so files in any
+    encoding are indexed.  The file is streamed chunk_size bytes at a time, so only a chunk and
+    the distinct trigrams are held in memory.  The sha1 is only computed
+    if hash_files is set.
+    """
+    h = hashlib.sha1() if hash_files else None
+    tokenizer = Tokenizer(block_size)
+    with open(file, "rb") as fp:
+        st = os.fstat(fp.fileno())
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            if h is not None:
+                h.update(chunk)
+            tokenizer.feed(chunk)
+    trigrams, blocks = tokenizer.finish()
+    return trigrams, (st.st_size, st.st_mtime_ns, NOHASH if h is None else h.digest()), blocks
+
+
+def too_large(file, max_size):
+    """
+    too_large returns the (size, mtime_ns, sha1) metadata of file, without
+    the sha1, if it has more than max_size bytes, else None.
+    """
+    if max_size is None:
+        return None
+    try:
+        st = os.stat(file)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns, NOHASH) if st.st_size > max_size else None
+
+
+def index_shard(files, hash_files=False, block_size=None, max_size=None):
+    """
+    index_shard indexes a shard of files in a worker process.
+    It returns the files that were indexed, the partial posting lists
+    keyed by trigram with file ids local to the shard, the file metadata,
+    the file blocks and the metadata of the skipped files by name.
+    Files of more than max_size bytes are skipped.
+    """
+    names = []
+    postings = defaultdict(posting_list)
+    metas = []
+    blocks = []
+    skipped = {}
+    for file in files:
+        meta = too_large(file, max_size)
+        if meta is not None:
+            skipped[file] = meta
+            continue
+        trigrams, meta, fblocks = read_trigrams(file, hash_files, block_size)
+        for t in trigrams:
+            postings[t].append(len(names))
+        names.append(file)
+        metas.append(meta)
+        blocks.append(fblocks)
+    return names, dict(postings), metas, blocks, skipped
+
+
+# Approximate memory of an in-memory posting list, per trigram and per file id.
+TRIGRAM_BYTES = 200
+POSTING_BYTES = 5
+
+
+def budget_shards(paths, budget):
+    """
+    budget_shards splits paths into contiguous shards of files totalling at
+    most budget bytes, so that the postings a worker returns for a shard,
+    which has at most a trigram per byte, stay within a share of the budget.
+    """
+    shards = [[]]
+    total = 0
+    for path in paths:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        if shards[-1] and total + size > budget:
+            shards.append([])
+            total = 0
+        shards[-1].append(path)
+        total += size
+    return shards if shards[0] else []
+
+
+def ordered_map(pool, func, items, window):
+    """
+    ordered_map yields func(item) for each of items, computed in pool, in
+    order, like pool.imap, but with at most window items submitted and not
+    yet consumed, so that results don't pile up when they come in faster
+    than the consumer handles them.
+    """
+    pending = deque()
+    for item in items:
+        if len(pending) == window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (item,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def walk(root):
+    paths = []
+    for root, _, files in os.walk(root):
+        for file in files:
+            paths.append(os.path.join(root, file))
+    return paths
+
+
 class Index:
-    def __init__(self, root=None):
-        self.index_file = "index.pkl"
+    def __init__(self, root=None, workers=1, hash_files=False, skip_ratio=None, index_file="index.idx",
+                 block_size=None, max_file_size=None, memory_budget=None):
+        self.index_file = index_file
+        # When set, build keeps the posting lists in memory under about
+        # memory_budget bytes, spilling sorted runs to disk, see extsort.
+        self.memory_budget = memory_budget
+        self.runs = None
+        # File ids in the in-memory posting lists.
+        self.npostings = 0
+        # Files of more than max_file_size bytes are not indexed.
+        self.max_file_size = max_file_size
+        # The number of files not indexed, by reason (TOO_LARGE).
+        self.skips = Counter()
+        # The metadata of the files not indexed, by name.  They are kept in
+        # the index file so update can tell them from new files.
+        self.unindexed = {}
+        # When set, a new index also records which blocks of at least
+        # block_size bytes of a file hold each trigram, see candidate_regions.
+        self.block_size = block_size
+        # Trigrams in more than skip_ratio of the files barely narrow
+        # an AND; when set, their posting lists are not intersected.
+        self.skip_ratio = skip_ratio
+        self.lookups = {}
+        self.skipped = 0
+        # Posting lists decoded during a batch, by trigram, see get_candidate_fileids_batch.
+        self.decoded = None
+        # Serializes the per query state above between threads.
+        self.lock = threading.Lock()
         if os.path.exists(self.index_file) and root is None:
-            with open(self.index_file, "rb") as fp:
-                self.index, self.files = pickle.load(fp)
-            self.fileid = len(self.files)    
+            self.open()
         else:
-            self.index = defaultdict(set)
+            self.index = defaultdict(posting_list)
             self.files = []
+            self.meta = []
+            self.blocks = []
+            self.deleted = set()
             self.fileid = 0
             if root is None:
                 logging.error('Error give file name')
                 quit()
             else:    
-                self.build(root)          
+                self.build(root, workers, hash_files)
 
-    def build(self, root):
+    def build(self, root, workers=1, hash_files=False):
         logging.info("index creation starting")
         start_time = time()
-        for root, _, files in os.walk(root):
-            for file in files:
-                file = os.path.join(root, file)
-                self.add_file(file)
-        logging.info("index created %s", str(time() - start_time))
-        with open(self.index_file, "wb") as fp:
-            pickle.dump((self.index, self.files), fp)
+        paths = walk(root)
+        if self.memory_budget:
+            # The runs go next to the index rather than to a temporary
+            # directory that may itself be held in memory.
+            self.runs = Runs(os.path.dirname(os.path.abspath(self.index_file)))
+            if self.block_size:
+                self.blocks = BlockSpill(self.runs.dir)
+        try:
+            if workers > 1:
+                self.build_parallel(paths, workers, hash_files)
+            else:
+                for file in paths:
+                    self.add_file(file, hash_files)
+            dur = time() - start_time
+            logging.info("index created %s", str(dur))
+            nbytes = sum(meta[0] for meta in self.meta)
+            logging.info("indexed %d files, %.1f files/s, %.2f MB/s", len(self.files),
+                         len(self.files) / max(dur, 1e-9), nbytes / max(dur, 1e-9) / 2 ** 20)
+            self.log_skips()
+            if self.runs is not None and self.runs.spilled:
+                logging.info("spilled %d sorted runs to %s, merging %d", self.runs.spilled, self.runs.dir,
+                             len(self.runs.paths) + 1)
+            self.write()
+        finally:
+            if self.runs is not None:
+                if self.block_size:
+                    self.blocks.close()
+                self.runs.close()
+                self.runs = None
         logging.info("index written to disk %s", str(time() - start_time))
+        if self.block_size:
+            size = os.path.getsize(self.index_file)
+            logging.info("block postings of %d byte blocks: %d bytes, %.1f%% of the %d byte index", self.block_size,
+                         self.index.block_bytes, 100 * self.index.block_bytes / size, size)
 
-    def add_file(self, file):
+    def build_parallel(self, paths, workers, hash_files=False):
+        """
+        build_parallel splits paths into contiguous shards and indexes them
+        in a pool of worker processes.  Shards are merged back in order, so
+        file ids are the same as those of a serial build.
+        """
+        # Several shards per worker so that one shard of big files
+        # doesn't leave the rest of the pool idle.
+        step = max(1, -(-len(paths) // (workers * 4)))
+        shards = [paths[i:i + step] for i in range(0, len(paths), step)]
+        # A shard is being indexed by each worker and up to as many more
+        # wait for the merge, which spills each one before taking the next.
+        window = workers * 2
+        if self.memory_budget:
+            # So the shards in flight hold about another memory budget.
+            share = self.memory_budget // (POSTING_BYTES * window)
+            shards = [part for shard in shards for part in budget_shards(shard, share)]
+        logging.info("indexing %d files in %d shards with %d workers", len(paths), len(shards), workers)
+        with Pool(workers) as pool:
+            shard = partial(index_shard, hash_files=hash_files, block_size=self.block_size,
+                            max_size=self.max_file_size)
+            for res in ordered_map(pool, shard, shards, window):
+                self.merge(*res)
+
+    def merge(self, names, postings, metas, blocks, skipped):
+        """
+        merge adds the partial posting lists of a shard to the index,
+        renumbering the shard's local file ids after the current files.
+        """
+        self.skips[TOO_LARGE] += len(skipped)
+        self.unindexed.update(skipped)
+        base = self.fileid
+        for t, fileids in postings.items():
+            self.index[t].extend(base + i for i in fileids)
+        self.files.extend(names)
+        self.meta.extend(metas)
+        self.blocks.extend(blocks)
+        self.fileid += len(names)
+        self.npostings += sum(map(len, postings.values()))
+        self.check_budget()
+
+    def update(self, root, hash_files=False):
+        """
+        update brings the index up to date with the files under root.
+        Only added and changed files are read and tokenized.  A changed file
+        gets a new file id; its old id, and the ids of files that were deleted,
+        are tombstoned until the next compact.  A file is unchanged if its size
+        and mtime match, or, with hash_files, if its sha1 matches.  Files
+        too large to index are recorded, not read, and not counted as added.
+        """
+        logging.info("index update starting")
+        start_time = time()
+        self.load()
+        live = {self.files[i]: i for i in range(len(self.files)) if i not in self.deleted}
+        skipped, self.unindexed = self.unindexed, {}
+        added = changed = 0
+        for file in walk(root):
+            i = live.pop(file, None)
+            if i is not None:
+                meta = self.stat(file, self.meta[i], hash_files)
+                if meta is not None:
+                    self.meta[i] = meta
+                    continue
+                self.deleted.add(i)
+                changed += 1
+            else:
+                meta = too_large(file, self.max_file_size)
+                if meta is not None:
+                    # Not read; only reported if it is new or changed.
+                    if file not in skipped or self.stat(file, skipped[file]) is None:
+                        self.skips[TOO_LARGE] += 1
+                    self.unindexed[file] = meta
+                    continue
+                added += 1
+            self.add_file(file, hash_files)
+        self.deleted.update(live.values())
+        logging.info("index updated %s: %d added, %d changed, %d deleted, %d tombstones", str(time() - start_time),
+                     added, changed, len(live), len(self.deleted))
+        self.log_skips()
+        self.write()
+
+    @staticmethod
+    def stat(file, meta, hash_files=False):
+        """
+        stat returns the current metadata of file if its contents are
+        the same as those described by meta, otherwise None.
+        """
         try:
-            with open(file, "r") as fp:
-                doc = fp.read()
-            prev = doc[:3]
-            if len(prev) == 3:
-                self.index[prev].add(self.fileid)
-            for char in doc[3:]:
-                prev = prev[1:] + char
-                self.index[prev].add(self.fileid)
-            self.fileid += 1
-            self.files.append(file)
-        except UnicodeDecodeError:
-            # logging.info("Couldn't read", file)
-            pass
+            st = os.stat(file)
+        except OSError:
+            return None
+        size, mtime_ns, digest = meta
+        if st.st_size != size:
+            return None
+        if st.st_mtime_ns == mtime_ns:
+            return meta
+        if hash_files and digest != NOHASH and hash_file(file) == digest:
+            return size, st.st_mtime_ns, digest
+        return None
+
+    def compact(self):
+        """
+        compact rewrites the index without the tombstoned files,
+        renumbering the remaining file ids.
+        """
+        logging.info("index compaction starting")
+        self.load()
+        remap = {}
+        files = []
+        meta = []
+        blocks = []
+        for i in range(len(self.files)):
+            if i not in self.deleted:
+                remap[i] = len(files)
+                files.append(self.files[i])
+                meta.append(self.meta[i])
+                blocks.append(self.blocks[i])
+        index = defaultdict(posting_list)
+        for t, fileids in self.index.items():
+            fileids = posting_list(remap[i] for i in fileids if i in remap)
+            if fileids:
+                index[t] = fileids
+        logging.info("purged %d tombstoned files", len(self.files) - len(files))
+        self.index, self.files, self.meta, self.blocks, self.deleted, self.fileid = \
+            index, files, meta, blocks, set(), len(files)
+        self.write()
+
+    # decodes the whole index file into memory so it can be modified
+    def load(self):
+        reader = self.index
+        self.index = defaultdict(posting_list)
+        for t, fileids in reader.items():
+            self.index[t] = fileids
+        self.files = list(reader.paths)
+        self.meta = [reader.meta(i) for i in range(len(self.files))]
+        # Block postings are kept encoded; file ids don't appear in them.
+        self.blocks = list(reader.encoded_blocks())
+        self.deleted = set(reader.deleted)
+        self.unindexed = reader.skipped()
+        self.fileid = len(self.files)
+        reader.close()
+
+    # writes the in memory index to the index file and maps it
+    def write(self):
+        index = self.index if self.runs is None else self.runs.merge(self.index)
+        write_index(self.index_file, index, self.files, self.meta, self.deleted, self.blocks, self.block_size,
+                    self.unindexed)
+        self.open()
+
+    # maps the index file, only the trailer is read here
+    def open(self):
+        with tracing.span("index_load"):
+            self.index = IndexReader(self.index_file)
+        self.block_size = self.index.block_size or None
+        self.files = self.index.paths
+        self.deleted = self.index.deleted
+        self.fileid = len(self.files)
+        self.lookups = {}
+
+    def add_file(self, file, hash_files=False):
+        meta = too_large(file, self.max_file_size)
+        if meta is not None:
+            self.skips[TOO_LARGE] += 1
+            self.unindexed[file] = meta
+            return
+        trigrams, meta, blocks = read_trigrams(file, hash_files, self.block_size)
+        for t in trigrams:
+            self.index[t].append(self.fileid)
+        self.fileid += 1
+        self.files.append(file)
+        self.meta.append(meta)
+        self.blocks.append(blocks)
+        self.npostings += len(trigrams)
+        self.check_budget()
+
+    # spills the in-memory posting lists to a sorted run once they outgrow the memory budget
+    def check_budget(self):
+        if self.runs is None:
+            return
+        if len(self.index) * TRIGRAM_BYTES + self.npostings * POSTING_BYTES <= self.memory_budget:
+            return
+        self.runs.spill(self.index)
+        self.index = defaultdict(posting_list)
+        self.npostings = 0
+
+    # logs the number of files that were not indexed
+    def log_skips(self):
+        if self.skips[TOO_LARGE]:
+            logging.info("skipped %d files larger than %d bytes", self.skips[TOO_LARGE], self.max_file_size)
 
     # returns the index
     def read(self):
         return self.index
 
-    # returns intersection of posting lists
+    # returns the index entries of the byte trigrams of t, None for a missing one.
+    # Entries are remembered for the query being evaluated.
+    def lookup(self, t):
+        entries = self.lookups.get(t)
+        if entries is None:
+            entries = [self.index.find(key) for key in trigram_keys(t)]
+            self.lookups[t] = entries
+        return entries
+
+    # returns the number of files that can contain trigram t, without decoding
+    def count(self, t):
+        return min(0 if entry is None else entry[0] for entry in self.lookup(t))
+
+    # returns the posting list of trigram t, decoded from the index file.
+    # A non-ascii trigram is several byte trigrams, all of which must be present.
+    # During a batch each list is decoded once and shared by the queries.
+    def postings(self, t):
+        if self.decoded is None:
+            return self.decode_postings(t)
+        fileids = self.decoded.get(t)
+        if fileids is None:
+            fileids = self.decoded[t] = self.decode_postings(t)
+        else:
+            tracing.count("posting_lists_shared")
+        return fileids
+
+    def decode_postings(self, t):
+        entries = sorted(self.lookup(t), key=lambda entry: 0 if entry is None else entry[0])
+        candid = None
+        with tracing.span("postings"):
+            for entry in entries:
+                if entry is None:
+                    return posting_list()
+                fileids = self.index.decode(entry)
+                tracing.count("posting_lists")
+                tracing.count("posting_ids", len(fileids))
+                candid = fileids if candid is None else self.list_and(candid, fileids)
+        return candid
+
+    # returns an upper bound of the number of files matching q from the posting list sizes
+    def estimate(self, q):
+        if q.op == Query.QNone:
+            return 0
+        if q.op == Query.QAll:
+            return len(self.files)
+        costs = [self.count(t) for t in q.trigram] + [self.estimate(s) for s in q.sub]
+        if q.op == Query.QAnd:
+            return min(costs, default=0)
+        return min(sum(costs), len(self.files))
+
+    # returns intersection of sorted posting lists
     @staticmethod
     def list_and(lst1, lst2):
-        return lst1 & lst2
-    
-    # returns union of posting lists
+        if len(lst1) > len(lst2):
+            lst1, lst2 = lst2, lst1
+        out = posting_list()
+        if len(lst1) * 8 < len(lst2):
+            # Much shorter list: binary search its ids in the longer one.
+            j = 0
+            n = len(lst2)
+            for x in lst1:
+                j = bisect_left(lst2, x, j)
+                if j == n:
+                    break
+                if lst2[j] == x:
+                    out.append(x)
+            return out
+        i = j = 0
+        n1, n2 = len(lst1), len(lst2)
+        while i < n1 and j < n2:
+            x, y = lst1[i], lst2[j]
+            if x == y:
+                out.append(x)
+                i += 1
+                j += 1
+            elif x < y:
+                i += 1
+            else:
+                j += 1
+        return out
+
+    # returns union of sorted posting lists
     @staticmethod
     def list_or(lst1, lst2):
-        return lst1 | lst2
+        if not lst1:
+            return lst2
+        if not lst2:
+            return lst1
+        out = posting_list()
+        i = j = 0
+        n1, n2 = len(lst1), len(lst2)
+        while i < n1 and j < n2:
+            x, y = lst1[i], lst2[j]
+            if x < y:
+                out.append(x)
+                i += 1
+            elif x > y:
+                out.append(y)
+                j += 1
+            else:
+                out.append(x)
+                i += 1
+                j += 1
+        out.extend(lst1[i:])
+        out.extend(lst2[j:])
+        return out
 
-    # returns candidate file ids
+    # returns candidate file ids, without the tombstoned files
     def get_candidate_fileids(self, q):
+        with self.lock:
+            self.lookups = {}
+            self.skipped = 0
+            candid = self.eval_query(q)
+            skipped = self.skipped
+        if skipped:
+            logging.info("skipped %d posting lists in more than %.0f%% of the files", skipped, self.skip_ratio * 100)
+        if self.deleted:
+            candid = posting_list(i for i in candid if i not in self.deleted)
+        return candid
 
-        candid = None
+    # returns the candidate file ids of each query of qs, as get_candidate_fileids
+    # does, decoding the posting list of a trigram once for all the queries
+    def get_candidate_fileids_batch(self, qs):
+        with self.lock:
+            self.lookups = {}
+            self.skipped = 0
+            self.decoded = {}
+            try:
+                candids = [self.eval_query(q) for q in qs]
+            finally:
+                self.decoded = None
+            skipped = self.skipped
+        if skipped:
+            logging.info("skipped %d posting lists in more than %.0f%% of the files", skipped, self.skip_ratio * 100)
+        if self.deleted:
+            candids = [posting_list(i for i in candid if i not in self.deleted) for candid in candids]
+        return candids
+
+    # returns the estimated number of candidate files of q, from the posting list lengths alone
+    def get_estimate(self, q):
+        with self.lock:
+            self.lookups = {}
+            return self.estimate(q)
+
+    # yields candidate file ids one at a time from a lazy plan, without the tombstoned files
+    def iter_candidate_fileids(self, q):
+        with self.lock:
+            self.lookups = {}
+            self.skipped = 0
+            with tracing.span("compile"):
+                plan = self.compile(q)
+            skipped = self.skipped
+        if skipped:
+            logging.info("skipped %d posting lists in more than %.0f%% of the files", skipped, self.skip_ratio * 100)
+        for fileid in iterate(plan):
+            if fileid not in self.deleted:
+                yield fileid
+
+    # returns a plan of lazy iterators matching q, with the terms of an AND ordered by cost
+    def compile(self, q):
         if q.op == Query.QNone:
-            return set()
+            return EmptyIterator()
 
         if q.op == Query.QAll:
-            return set(range(len(self.files)))
+            return RangeIterator(len(self.files))
 
+        children = []
         if q.op == Query.QAnd:
-            candid = None
-            for t in q.trigram:
-                candid = self.index[t]
-                break
+            terms = [(self.count(t), False, t) for t in q.trigram] + [(self.estimate(s), True, s) for s in q.sub]
+            terms.sort(key=lambda term: term[0])
+            for cost, is_sub, term in terms:
+                if cost == 0:
+                    return EmptyIterator()
+                if children and self.skip_ratio is not None and cost > self.skip_ratio * len(self.files):
+                    self.skipped += 1
+                    continue
+                children.append(self.compile(term) if is_sub else self.iterate(term))
+            if len(children) > 1:
+                return AndIterator(children)
 
-            for t in q.trigram:
-                candid = self.list_and(candid, self.index[t])
+        if q.op == Query.QOr:
+            children = [self.iterate(t) for t in q.trigram] + [self.compile(s) for s in q.sub]
+            if len(children) > 1:
+                return OrIterator(children)
 
-            if candid is None:
-                for s in q.sub:
-                    candid = self.get_candidate_fileids(s)
+        return children[0] if children else EmptyIterator()
 
-            for s in q.sub:
-                candid = self.list_and(candid, self.get_candidate_fileids(s))
+    # returns a lazy iterator over the posting list of trigram t
+    def iterate(self, t):
+        entries = self.lookup(t)
+        if None in entries:
+            return EmptyIterator()
+        children = [self.index.iterate(entry) for entry in sorted(entries, key=lambda entry: entry[0])]
+        tracing.count("posting_lists", len(children))
+        tracing.count("posting_ids", sum(entry[0] for entry in entries))
+        return children[0] if len(children) == 1 else AndIterator(children)
+
+    # returns the sorted file ids matching q, evaluated over the posting lists.
+    # An AND intersects its terms smallest first and stops once it is empty.
+    def eval_query(self, q):
+        if q.op == Query.QNone:
+            return posting_list()
+
+        if q.op == Query.QAll:
+            return posting_list(range(len(self.files)))
+
+        with tracing.span("eval"):
+            return self.eval_node(q)
+
+    # returns the file ids matching the AND or OR node q
+    def eval_node(self, q):
+        candid = None
+        if q.op == Query.QAnd:
+            terms = [(self.count(t), False, t) for t in q.trigram] + [(self.estimate(s), True, s) for s in q.sub]
+            terms.sort(key=lambda term: term[0])
+            for cost, is_sub, term in terms:
+                if candid is not None:
+                    if not candid:
+                        break
+                    if self.skip_ratio is not None and cost > self.skip_ratio * len(self.files):
+                        self.skipped += 1
+                        continue
+                fileids = self.eval_query(term) if is_sub else self.postings(term)
+                candid = fileids if candid is None else self.list_and(candid, fileids)
 
         if q.op == Query.QOr:
-            candid = set()
+            candid = posting_list()
             for t in q.trigram:
-                candid = self.list_or(candid, self.index[t])
+                candid = self.list_or(candid, self.postings(t))
             for s in q.sub:
-                candid = self.list_or(candid, self.get_candidate_fileids(s))
+                candid = self.list_or(candid, self.eval_query(s))
+
+        return posting_list() if candid is None else candid
+
+    # returns the (start, end) byte ranges of the blocks of file fileid that
+    # can hold a match of q, end None for the end of the file, or None if
+    # the whole file has to be searched.  Only valid for a regex whose
+    # matches lie within a line, as a block holds whole lines.
+    def candidate_regions(self, fileid, q):
+        fblocks = self.index.blocks(fileid)
+        if fblocks is None:
+            return None
+        with tracing.span("blocks"):
+            mask = self.block_mask(fblocks, q)
+        if mask == fblocks.all:
+            return None
+        starts = fblocks.starts()
+        regions = []
+        k = 0
+        while k < fblocks.nblocks:
+            if not mask >> k & 1:
+                k += 1
+                continue
+            first = k
+            while k < fblocks.nblocks and mask >> k & 1:
+                k += 1
+            regions.append((starts[first], starts[k] if k < fblocks.nblocks else None))
+        tracing.count("blocks", fblocks.nblocks)
+        tracing.count("blocks_skipped", fblocks.nblocks - bin(mask).count("1"))
+        return regions
 
-        return set() if candid is None else candid
+    # returns the set of blocks of a file that can hold a match of q, as an int bitmap
+    def block_mask(self, fblocks, q):
+        if q.op == Query.QNone:
+            return 0
+        if q.op == Query.QAll:
+            return fblocks.all
+        if q.op == Query.QAnd:
+            mask = fblocks.all
+            for t in q.trigram:
+                for key in trigram_keys(t):
+                    mask &= fblocks.mask(key)
+            for s in q.sub:
+                if not mask:
+                    break
+                mask &= self.block_mask(fblocks, s)
+            return mask
+        mask = 0
+        for t in q.trigram:
+            tmask = fblocks.all
+            for key in trigram_keys(t):
+                tmask &= fblocks.mask(key)
+            mask |= tmask
+        for s in q.sub:
+            mask |= self.block_mask(fblocks, s)
+        return mask
 
     def get_filenames(self, fileids):
         return list(map(lambda x: self.files[x], fileids))
 
     def get_filecount(self):
-        return len(self.files)
+        return len(self.files) - len(self.deleted)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,563 @@
+import itertools
+import mmap
+import os
+import struct
+from array import array
+
+# On-disk layout of the trigram index.  Everything is little endian.
+#
+#   magic            8 bytes
+#   path data        utf-8 encoded file names, back to back
+#   path offsets     (npaths + nskipped + 1) x uint64, offsets into the path data
+#   file metadata    (npaths + nskipped) x (uint64 size, int64 mtime_ns, 20 byte sha1)
+#                    the sha1 is all zeros when it wasn't computed
+#   tombstones       ntombstones x uint32, sorted ids of deleted files
+#   posting data     one list per trigram: its skip pointers followed by
+#                    the delta + varint encoded file ids
+#   block data       the block postings of the files split into blocks,
+#                    see below; empty unless the index has a block size
+#   block offsets    npaths x uint64, offset + 1 into the block data of
+#                    each file's block postings, 0 for a file in one block
+#   trigram table    ntrigrams x (uint32 trigram, uint32 count, uint64 offset)
+#                    sorted by trigram, offset is into the posting data
+#
+# The nskipped files after the npaths indexed ones were left out of the
+# index (see Index.unindexed); only their names and metadata are kept,
+# so an update can tell whether they changed.
+#
+# Trigrams are byte level: the three bytes packed big endian into 24 bits.
+#
+# A posting list of count ids has (count - 1) // SKIP_INTERVAL skip pointers,
+# (uint32 id, uint32 offset) each.  Skip pointer j gives the id before
+# posting j * SKIP_INTERVAL and the offset of that posting in the varints,
+# so decoding can resume there.
+#   trailer          see TRAILER
+#
+# The trigram table has fixed size records so a lookup is a binary search
+# over the mmap, and only the posting lists a query touches get decoded.
+#
+# An index built with a block size also records which blocks of a file
+# hold each of its trigrams.  A file is split into blocks of at least
+# block size bytes, each ending at the end of a line (or of the file).
+# The block postings of a file are
+#
+#   header           uint32 nblocks, uint32 ntrigrams
+#   block starts     nblocks x uint64, byte offset of each block in the file
+#   block table      ntrigrams x (uint32 trigram, uint32 offset), sorted by
+#                    trigram, offset is into the block lists
+#   block lists      per trigram, a varint n followed by n delta + varint
+#                    encoded block numbers, or, when that is smaller, n = 0
+#                    followed by a little endian bitmap of nblocks bits
+#
+# The trigrams of a block are those lying wholly inside it.
+
+MAGIC = b"csidx06\n"
+TRAILER = struct.Struct("<QQQQQQQQQQQQQ8s")
+ENTRY = struct.Struct("<IIQ")
+OFFSET = struct.Struct("<Q")
+FILEMETA = struct.Struct("<Qq20s")
+FILEID = struct.Struct("<I")
+BLOCKHEADER = struct.Struct("<II")
+BLOCKSTART = struct.Struct("<Q")
+BLOCKENTRY = struct.Struct("<II")
+SKIP = struct.Struct("<II")
+SKIP_INTERVAL = 128
+
+# END is the position of a posting iterator that is exhausted.
+# It is larger than any file id.
+END = 1 << 32
+
+
+def pack_trigram(b):
+    """
+    pack_trigram packs 3 bytes into a 24 bit integer trigram.
+    Sorting the packed trigrams sorts the byte strings.
+    """
+    return (b[0] << 16) | (b[1] << 8) | b[2]
+
+
+def unpack_trigram(key):
+    """
+    unpack_trigram is the inverse of pack_trigram.
+    """
+    return bytes((key >> 16, (key >> 8) & 0xff, key & 0xff))
+
+
+def trigram_keys(t):
+    """
+    trigram_keys returns the packed byte trigrams of the utf-8 encoding
+    of the 3 character string t.  A file contains t only if it contains
+    all of them; t is a single byte trigram if it is ascii.
+    """
+    b = t.encode("utf-8")
+    return [pack_trigram(b[i:i + 3]) for i in range(len(b) - 2)]
+
+
+def nskips(count):
+    return (count - 1) // SKIP_INTERVAL if count else 0
+
+
+def encode_varint(n, out):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def decode_varint(buf, pos):
+    """
+    decode_varint returns the varint at pos in buf and the position after it.
+    """
+    n = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def encode_blocks(starts, blocks, out):
+    """
+    encode_blocks appends the block postings of a file to out: the
+    offsets at which its blocks start and, for each trigram, the sorted
+    numbers of the blocks holding it.
+    """
+    nbytes = (len(starts) + 7) // 8
+    table = []
+    lists = bytearray()
+    for t in sorted(blocks):
+        table.append(BLOCKENTRY.pack(t, len(lists)))
+        nums = blocks[t]
+        data = bytearray()
+        encode_varint(len(nums), data)
+        prev = 0
+        for k in nums:
+            encode_varint(k - prev, data)
+            prev = k
+        if len(data) > nbytes + 1:
+            data = bytearray(b"\0") + sum(1 << k for k in nums).to_bytes(nbytes, "little")
+        lists += data
+    out += BLOCKHEADER.pack(len(starts), len(table))
+    out += b"".join(BLOCKSTART.pack(start) for start in starts)
+    out += b"".join(table)
+    out += lists
+
+
+class FileBlocks:
+    """
+    FileBlocks reads the block postings of a file in the mmap.  Block
+    sets are returned as ints, bit k standing for block k, so a query is
+    evaluated over them with & and |.
+    """
+
+    def __init__(self, buf, pos):
+        self.buf = buf
+        self.nblocks, self.ntrigrams = BLOCKHEADER.unpack_from(buf, pos)
+        self.starts_off = pos + BLOCKHEADER.size
+        self.table_off = self.starts_off + self.nblocks * BLOCKSTART.size
+        self.lists_off = self.table_off + self.ntrigrams * BLOCKENTRY.size
+        self.all = (1 << self.nblocks) - 1
+
+    def starts(self):
+        return [BLOCKSTART.unpack_from(self.buf, self.starts_off + k * BLOCKSTART.size)[0]
+                for k in range(self.nblocks)]
+
+    def mask(self, key):
+        """
+        mask returns the set of blocks holding the packed trigram key.
+        """
+        lo, hi = 0, self.ntrigrams
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k, offset = BLOCKENTRY.unpack_from(self.buf, self.table_off + mid * BLOCKENTRY.size)
+            if k < key:
+                lo = mid + 1
+            elif k > key:
+                hi = mid
+            else:
+                return self.decode(self.lists_off + offset)
+        return 0
+
+    def decode(self, pos):
+        n, pos = decode_varint(self.buf, pos)
+        if n == 0:
+            return int.from_bytes(self.buf[pos:pos + (self.nblocks + 7) // 8], "little")
+        mask = 0
+        k = 0
+        for _ in range(n):
+            delta, pos = decode_varint(self.buf, pos)
+            k += delta
+            mask |= 1 << k
+        return mask
+
+    def items(self):
+        """
+        items yields every (trigram, sorted block numbers) pair of the file.
+        """
+        for i in range(self.ntrigrams):
+            key, offset = BLOCKENTRY.unpack_from(self.buf, self.table_off + i * BLOCKENTRY.size)
+            mask = self.decode(self.lists_off + offset)
+            nums = []
+            while mask:
+                low = mask & -mask
+                nums.append(low.bit_length() - 1)
+                mask ^= low
+            yield key, nums
+
+
+def encode_postings(fileids, out):
+    """
+    encode_postings appends the skip pointers and the varint deltas
+    of the sorted file ids to out.
+    """
+    data = bytearray()
+    skips = []
+    prev = 0
+    for k, fileid in enumerate(fileids):
+        if k and k % SKIP_INTERVAL == 0:
+            skips.append(SKIP.pack(prev, len(data)))
+        delta = fileid - prev
+        prev = fileid
+        while delta >= 0x80:
+            data.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        data.append(delta)
+    out += b"".join(skips)
+    out += data
+
+
+def decode_postings(buf, pos, count):
+    """
+    decode_postings decodes the posting list of count ids at pos in buf
+    into a sorted array of file ids.
+    """
+    fileids = array("I")
+    pos += nskips(count) * SKIP.size
+    prev = 0
+    for _ in range(count):
+        delta = 0
+        shift = 0
+        while True:
+            b = buf[pos]
+            pos += 1
+            delta |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        prev += delta
+        fileids.append(prev)
+    return fileids
+
+
+class PostingIterator:
+    """
+    PostingIterator walks a posting list in the mmap without decoding it
+    up front.  doc is the current file id: -1 before the first call to
+    next and END once the list is exhausted.  advance_to uses the skip
+    pointers to jump over whole blocks of ids below its target.
+    """
+
+    def __init__(self, buf, pos, count):
+        self.buf = buf
+        self.count = count
+        self.skip_pos = pos
+        self.nskip = nskips(count)
+        self.data = pos + self.nskip * SKIP.size
+        self.pos = self.data
+        self.k = 0
+        self.doc = -1
+
+    def next(self):
+        """
+        next moves to the next file id and returns it.
+        """
+        if self.k == self.count:
+            self.doc = END
+            return END
+        buf = self.buf
+        pos = self.pos
+        delta = 0
+        shift = 0
+        while True:
+            b = buf[pos]
+            pos += 1
+            delta |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        self.pos = pos
+        self.doc = (self.doc if self.k else 0) + delta
+        self.k += 1
+        return self.doc
+
+    def advance_to(self, target):
+        """
+        advance_to moves to the first file id >= target and returns it.
+        """
+        if self.doc >= target:
+            return self.doc
+        # Find the last skip pointer ahead of us whose previous id is below
+        # target; all the ids before it are below target too.
+        lo, hi = self.k // SKIP_INTERVAL + 1, self.nskip + 1
+        jump = None
+        while lo < hi:
+            mid = (lo + hi) // 2
+            prev, offset = SKIP.unpack_from(self.buf, self.skip_pos + (mid - 1) * SKIP.size)
+            if prev < target:
+                jump = (mid, prev, offset)
+                lo = mid + 1
+            else:
+                hi = mid
+        if jump is not None:
+            j, prev, offset = jump
+            self.k = j * SKIP_INTERVAL
+            self.pos = self.data + offset
+            self.doc = prev
+        while self.doc < target:
+            self.next()
+        return self.doc
+
+
+def write_index(path, index, files, meta, deleted=(), blocks=None, block_size=0, skipped=None):
+    """
+    write_index writes the trigram -> sorted file id arrays in index, the
+    file names in files, their (size, mtime_ns, sha1) metadata in meta,
+    the ids of deleted files and the name -> metadata dict of the files
+    left out of the index in skipped to path in the binary index format.
+    index may also be an iterable of (trigram, file id array) pairs in
+    trigram order, such as a merge of sorted runs (see extsort); the lists
+    are encoded and written one at a time.
+    With a block_size, blocks holds for each file None if it is a single
+    block, or its block starts and trigram -> sorted block numbers dict,
+    or those already encoded by encode_blocks.
+    The file is written next to path and renamed over it, so readers
+    that still have the old index mapped are not affected.
+    """
+    items = ((t, index[t]) for t in sorted(index)) if isinstance(index, dict) else index
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as fp:
+        fp.write(MAGIC)
+
+        skipped = skipped or {}
+        path_off = fp.tell()
+        offsets = [0]
+        for name in itertools.chain(files, skipped):
+            data = name.encode("utf-8", "surrogateescape")
+            fp.write(data)
+            offsets.append(offsets[-1] + len(data))
+
+        path_index_off = fp.tell()
+        for off in offsets:
+            fp.write(OFFSET.pack(off))
+
+        meta_off = fp.tell()
+        for size, mtime_ns, digest in itertools.chain(meta, skipped.values()):
+            fp.write(FILEMETA.pack(size, mtime_ns, digest))
+
+        tomb_off = fp.tell()
+        deleted = sorted(deleted)
+        for fileid in deleted:
+            fp.write(FILEID.pack(fileid))
+
+        posting_off = fp.tell()
+        table = bytearray()
+        for t, fileids in items:
+            table += ENTRY.pack(t, len(fileids), fp.tell() - posting_off)
+            postings = bytearray()
+            encode_postings(fileids, postings)
+            fp.write(postings)
+
+        block_off = fp.tell()
+        block_offsets = array("Q")
+        for fblocks in blocks or [None] * len(files):
+            if fblocks is None:
+                block_offsets.append(0)
+                continue
+            block_offsets.append(fp.tell() - block_off + 1)
+            if not isinstance(fblocks, (bytes, bytearray)):
+                data = bytearray()
+                encode_blocks(fblocks[0], fblocks[1], data)
+                fblocks = data
+            fp.write(fblocks)
+        block_index_off = fp.tell()
+        fp.write(b"".join(OFFSET.pack(off) for off in block_offsets))
+
+        table_off = fp.tell()
+        fp.write(table)
+
+        fp.write(TRAILER.pack(len(files), path_off, path_index_off, meta_off, len(deleted), tomb_off,
+                              len(table) // ENTRY.size, table_off, posting_off, block_size or 0, block_off,
+                              block_index_off, len(skipped), MAGIC))
+    os.replace(tmp, path)
+
+
+class PathTable:
+    """
+    PathTable is a read only sequence of the file names in an index file.
+    Names are decoded from the mmap on access.
+    """
+
+    def __init__(self, buf, count, data_off, index_off):
+        self.buf = buf
+        self.count = count
+        self.data_off = data_off
+        self.index_off = index_off
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("file id out of range")
+        start, = OFFSET.unpack_from(self.buf, self.index_off + i * OFFSET.size)
+        end, = OFFSET.unpack_from(self.buf, self.index_off + (i + 1) * OFFSET.size)
+        data = self.buf[self.data_off + start:self.data_off + end]
+        return data.decode("utf-8", "surrogateescape")
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+
+class IndexReader:
+    """
+    IndexReader gives access to an index file through a read only mmap.
+    Opening it only reads the trailer; trigram lookups are binary searches
+    over the trigram table and decode just the posting list asked for.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as fp:
+            self.buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.buf) < len(MAGIC) + TRAILER.size or self.buf[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not an index file" % path)
+        (npaths, path_off, path_index_off, self.meta_off, ntombstones, tomb_off, self.ntrigrams, self.table_off,
+         self.posting_off, self.block_size, self.block_off, self.block_index_off, self.nskipped,
+         magic) = TRAILER.unpack_from(self.buf, len(self.buf) - TRAILER.size)
+        if magic != MAGIC:
+            raise ValueError("%s is truncated" % path)
+        # Size of the block postings, offsets included.
+        self.block_bytes = self.table_off - self.block_off if self.block_size else 0
+        self.paths = PathTable(self.buf, npaths, path_off, path_index_off)
+        # The names of the indexed files followed by those of the skipped ones.
+        self.all_paths = PathTable(self.buf, npaths + self.nskipped, path_off, path_index_off)
+        self.deleted = {FILEID.unpack_from(self.buf, tomb_off + i * FILEID.size)[0] for i in range(ntombstones)}
+
+    def meta(self, fileid):
+        """
+        meta returns the (size, mtime_ns, sha1) recorded for fileid.
+        """
+        return FILEMETA.unpack_from(self.buf, self.meta_off + fileid * FILEMETA.size)
+
+    def skipped(self):
+        """
+        skipped returns the name -> (size, mtime_ns, sha1) dict of the files
+        left out of the index.
+        """
+        npaths = len(self.paths)
+        return {self.all_paths[i]: self.meta(i) for i in range(npaths, npaths + self.nskipped)}
+
+    def blocks(self, fileid):
+        """
+        blocks returns the FileBlocks of fileid, or None if the index has
+        no block postings or the file is a single block.
+        """
+        if not self.block_size:
+            return None
+        off, = OFFSET.unpack_from(self.buf, self.block_index_off + fileid * OFFSET.size)
+        return FileBlocks(self.buf, self.block_off + off - 1) if off else None
+
+    def encoded_blocks(self):
+        """
+        encoded_blocks yields for every file None if it is a single block,
+        else its block postings as encoded by encode_blocks, which
+        write_index takes back as they are.
+        """
+        if not self.block_size:
+            yield from [None] * len(self.paths)
+            return
+        offsets = [OFFSET.unpack_from(self.buf, self.block_index_off + i * OFFSET.size)[0]
+                   for i in range(len(self.paths))]
+        # Files' block postings are back to back, in file id order.
+        end = self.block_index_off - self.block_off + 1
+        ends = []
+        for off in reversed(offsets):
+            ends.append(end)
+            if off:
+                end = off
+        for off, end in zip(offsets, reversed(ends)):
+            yield self.buf[self.block_off + off - 1:self.block_off + end - 1] if off else None
+
+    def find(self, key):
+        """
+        find returns the (count, offset) entry of the packed trigram key,
+        or None if it is not in the index.
+        """
+        lo, hi = 0, self.ntrigrams
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k, count, offset = ENTRY.unpack_from(self.buf, self.table_off + mid * ENTRY.size)
+            if k < key:
+                lo = mid + 1
+            elif k > key:
+                hi = mid
+            else:
+                return count, offset
+        return None
+
+    def count(self, key):
+        """
+        count returns the length of the posting list of key.
+        """
+        entry = self.find(key)
+        return 0 if entry is None else entry[0]
+
+    def postings(self, key):
+        """
+        postings returns the sorted array of file ids containing key.
+        """
+        entry = self.find(key)
+        if entry is None:
+            return array("I")
+        return self.decode(entry)
+
+    def decode(self, entry):
+        """
+        decode returns the posting list of an entry returned by find.
+        """
+        count, offset = entry
+        return decode_postings(self.buf, self.posting_off + offset, count)
+
+    def iterate(self, entry):
+        """
+        iterate returns a lazy PostingIterator over the posting list of an entry returned by find.
+        """
+        count, offset = entry
+        return PostingIterator(self.buf, self.posting_off + offset, count)
+
+    def trigrams(self):
+        """
+        trigrams yields every packed trigram in the index in sorted order.
+        """
+        for i in range(self.ntrigrams):
+            key, _, _ = ENTRY.unpack_from(self.buf, self.table_off + i * ENTRY.size)
+            yield key
+
+    def items(self):
+        """
+        items yields every (trigram, posting list) pair in sorted order.
+        """
+        for i in range(self.ntrigrams):
+            key, count, offset = ENTRY.unpack_from(self.buf, self.table_off + i * ENTRY.size)
+            yield key, decode_postings(self.buf, self.posting_off + offset, count)
+
+    def __len__(self):
+        return self.ntrigrams
+
+    def close(self):
+        self.buf.close()
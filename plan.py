@@ -0,0 +1,128 @@
+from heapq import heapify, heapreplace
+from indexfile import END
+
+# An execution plan for a Query is a tree of lazy iterators over sorted
+# file ids.  Every iterator has the interface of indexfile.PostingIterator:
+# doc is the current file id (-1 before the first next, END at the end),
+# next moves to the following id, and advance_to(target) moves to the
+# first id >= target.  Nothing is materialized, so a plan yields its first
+# candidates before the rest of the posting lists have been read.
+
+
+class EmptyIterator:
+    """
+    EmptyIterator matches no files.
+    """
+
+    def __init__(self):
+        self.doc = -1
+
+    def next(self):
+        self.doc = END
+        return END
+
+    def advance_to(self, target):
+        self.doc = END
+        return END
+
+
+class RangeIterator:
+    """
+    RangeIterator matches every file id below n.
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self.doc = -1
+
+    def next(self):
+        return self.advance_to(self.doc + 1)
+
+    def advance_to(self, target):
+        if self.doc < target:
+            self.doc = target if target < self.n else END
+        return self.doc
+
+
+class AndIterator:
+    """
+    AndIterator intersects its children by leapfrogging: each child in turn
+    is advanced to the largest id seen so far, until they all agree.
+    Children should be ordered with the most selective first, so that the
+    expensive ones are advanced in big jumps.
+    """
+
+    def __init__(self, children):
+        self.children = children
+        self.doc = -1
+
+    def align(self, target):
+        while target != END:
+            for child in self.children:
+                doc = child.advance_to(target)
+                if doc != target:
+                    target = doc
+                    break
+            else:
+                break
+        self.doc = target
+        return target
+
+    def next(self):
+        return self.align(self.children[0].next())
+
+    def advance_to(self, target):
+        if self.doc >= target:
+            return self.doc
+        return self.align(self.children[0].advance_to(target))
+
+
+class OrIterator:
+    """
+    OrIterator merges its children with a heap keyed by their current id.
+    """
+
+    def __init__(self, children):
+        self.children = children
+        self.heap = None
+        self.doc = -1
+
+    def start(self, target):
+        for child in self.children:
+            child.advance_to(target)
+        self.heap = [(child.doc, i) for i, child in enumerate(self.children)]
+        heapify(self.heap)
+
+    def next(self):
+        if self.heap is None:
+            self.start(0)
+        else:
+            heap = self.heap
+            while heap[0][0] == self.doc:
+                i = heap[0][1]
+                heapreplace(heap, (self.children[i].next(), i))
+        self.doc = self.heap[0][0]
+        return self.doc
+
+    def advance_to(self, target):
+        if self.doc >= target:
+            return self.doc
+        if self.heap is None:
+            self.start(target)
+        else:
+            heap = self.heap
+            while heap[0][0] < target:
+                i = heap[0][1]
+                heapreplace(heap, (self.children[i].advance_to(target), i))
+        self.doc = self.heap[0][0]
+        return self.doc
+
+
+def iterate(plan):
+    """
+    iterate yields the file ids matched by plan one at a time.
+    """
+    doc = plan.next()
+    while doc != END:
+        yield doc
+        doc = plan.next()
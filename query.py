@@ -1,4 +1,5 @@
-from copy import deepcopy
+from functools import lru_cache
+from weakref import WeakValueDictionary
 from stringset import clean, isSubsetOf, union
 
 
@@ -11,34 +12,69 @@ class Query:
     quite a bit more.  We can then filter target files by whether they match
     the Query (using a trigram index) before running the comparatively
     more expensive regexp machinery.
+
+    Queries are immutable and hash-consed: constructing a Query returns
+    the existing node with the same op, trigrams and subqueries if there
+    is one, so identical subtrees are shared and never need copying, and
+    two queries are structurally equal exactly when they are the same object.
+    The trigrams and subqueries are sets: they are kept sorted and without
+    duplicates, so the order they are given in doesn't matter.
     """
     QAll = 0  # Everything matches
     QNone = 1  # Nothing matches
     QAnd = 2  # All in Sub and Trigram must match
     QOr = 3  # At least one in Sub or Trigram must match
 
-    def __init__(self, o, trigram=None, sub=None):
-        self.op = o
-        self.trigram = [] if trigram is None else trigram
-        self.sub = [] if sub is None else sub
+    __slots__ = ("op", "trigram", "sub", "order", "__weakref__")
+
+    # Interned nodes, keyed by (op, trigram, sub).  Subqueries are
+    # interned too, so the keys compare them by identity.
+    nodes = WeakValueDictionary()
+
+    def __new__(cls, o, trigram=None, sub=None):
+        trigram = tuple(sorted(set(trigram))) if trigram else ()
+        sub = tuple(sorted(set(sub), key=lambda s: s.order)) if sub else ()
+        key = (o, trigram, sub)
+        q = cls.nodes.get(key)
+        if q is None:
+            q = object.__new__(cls)
+            object.__setattr__(q, "op", o)
+            object.__setattr__(q, "trigram", trigram)
+            object.__setattr__(q, "sub", sub)
+            # The structure of q, which subqueries are sorted by.
+            object.__setattr__(q, "order", (o, trigram, tuple(s.order for s in sub)))
+            cls.nodes[key] = q
+        return q
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Query is immutable")
+
+    def __reduce__(self):
+        return Query, (self.op, self.trigram, self.sub)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
 
     def q_and(self, r):
         """
-        and returns the query q AND r, possibly reusing q's and r's storage.  
+        and returns the query q AND r.
         q_and equivalent to "and" in regexp.go, and is a keyword in python.
         """
         return self.andOr(r, Query.QAnd)
 
     def q_or(self, r):
         """
-        or returns the query q OR r, possibly reusing q's and r's storage.
+        or returns the query q OR r.
         q_or equivalent to "or" in regexp.go, or is a keyword in python.
         """
         return self.andOr(r, Query.QOr)
 
     def andOr(self, r, op):
         """
-        andOr returns the query q AND r or q OR r, possibly reusing q's and r's storage.
+        andOr returns the query q AND r or q OR r, sharing q's and r's subtrees.
         It works hard to avoid creating unnecessarily complicated structures.
         """
         q = self
@@ -60,45 +96,38 @@ class Query:
         if q.implies(r):
             # print(q, "implies", r)
             if op == Query.QAnd:
-                return deepcopy(q)
-            return deepcopy(r)
+                return q
+            return r
         if r.implies(q):
             # print(r, "implies", q)
             if op == Query.QAnd:
-                return deepcopy(r)
-            return deepcopy(q)
+                return r
+            return q
 
         # Both q and r are QAnd or Qor.
         # If they match or can be made to match, merge.
         qAtom = len(q.trigram) == 1 and len(q.sub) == 0
         rAtom = len(r.trigram) == 1 and len(r.sub) == 0
         if q.op == op and (r.op == op or rAtom):
-            q.trigram = union(q.trigram, r.trigram, False)
-            q.sub.extend(r.sub)
-            return deepcopy(q)
+            return Query(op, union(q.trigram, r.trigram, False), q.sub + r.sub)
         if r.op == op and qAtom:
-            r.trigram = union(r.trigram, q.trigram, False)
-            return deepcopy(r)
+            return Query(op, union(r.trigram, q.trigram, False), r.sub)
         if qAtom and rAtom:
-            q.op = op
-            q.trigram.extend(r.trigram)
-            return deepcopy(q)
+            return Query(op, q.trigram + r.trigram)
 
         # If one matches the op, add the other to it.
         if q.op == op:
-            q.sub.append(r)
-            return deepcopy(q)
+            return Query(op, q.trigram, q.sub + (r,))
         if r.op == op:
-            r.sub.append(q)
-            return deepcopy(r)
+            return Query(op, r.trigram, r.sub + (q,))
 
         # We are creating an AND of ORs or an OR of ANDs.
         # Factor out common trigrams, if any.
         qs = set(q.trigram)
         rs = set(r.trigram)
         common = qs & rs
-        q.trigram = list(qs - common)
-        r.trigram = list(rs - common)
+        q = Query(q.op, list(qs - common), q.sub)
+        r = Query(r.op, list(rs - common), r.sub)
         common = list(common)
 
         if len(common) > 0:
@@ -123,59 +152,42 @@ class Query:
             return t.andOr(s, t.op)
 
         # Otherwise just create the op.
-        return Query(op, sub=[deepcopy(q), deepcopy(r)])
+        return Query(op, sub=[q, r])
 
     def implies(self, r):
         """
         implies reports whether q implies r.
         It is okay for it to return false negatives.
         """
-        q = self
-        if q.op == Query.QNone or r.op == Query.QAll:
-            # False implies everything.
-            # Everything implies True.
-            return True
-        if q.op == Query.QAll or r.op == Query.QNone:
-            # True implies nothing.
-            # Nothing implies False
-            return False
-        if q.op == Query.QAnd or (q.op == Query.QOr and len(q.trigram) == 1 and len(q.sub) == 0):
-            return trigramsImply(q.trigram, r)
-
-        if q.op == Query.QOr and r.op == Query.QOr and len(q.trigram) > 0 and len(q.sub) == 0 and isSubsetOf(q.trigram,
-                                                                                                             r.trigram):
-            return True
-        return False
+        return implies(self, r)
 
     def maybeRewrite(self, op):
         """
-        maybeRewrite rewrites q to use op if it is possible to do so
+        maybeRewrite returns q rewritten to use op if it is possible to do so
         without changing the meaning.  It also simplifies if the node
         """
         q = self
         if q.op != Query.QAnd and q.op != Query.QOr:
-            return
+            return q
 
         n = len(q.sub) + len(q.trigram)
 
         # AND/OR doing real work?  Can't rewrite.
         if n > 1:
-            return
+            return q
 
         # Nothing left in the AND/OR?
         if n == 0:
             if q.op == Query.QAnd:
-                q.op = Query.QAll
-            else:
-                q.op = Query.QNone
-            return
+                return allQuery
+            return noneQuery
 
         # Just a sub-node: throw away wrapper.
         if len(q.sub) == 1:
             q = q.sub[0]
 
         # Just a trigram: can use either op.
-        q.op = op
+        return Query(op, q.trigram, q.sub)
 
     def andTrigrams(self, t):
         """
@@ -186,10 +198,10 @@ class Query:
         # that any trigrams must be present, so use ALL.
         # q AND ALL = q.
         if len(t) == 0 or min(len(x) for x in t) < 3:
-            return deepcopy(q)
+            return q
 
         # print("andTrigrams", t)
-        q_or = deepcopy(noneQuery)
+        q_or = noneQuery
         for tt in t:
             trig = []
             for i in range(0, len(tt) - 2):
@@ -198,8 +210,7 @@ class Query:
             clean(trig, False)
             # print(tt, "trig", trig)
             q_or = q_or.q_or(Query(Query.QAnd, trig))
-        q = q.q_and(q_or)
-        return deepcopy(q)
+        return q.q_and(q_or)
 
     def __str__(self):
         # not applicable in python
@@ -237,7 +248,35 @@ class Query:
         return s
 
 
+@lru_cache(maxsize=4096)
+def implies(q, r):
+    """
+    implies reports whether q implies r, see Query.implies.
+    Queries are hash-consed, so the result is memoized by node identity.
+    """
+    if q.op == Query.QNone or r.op == Query.QAll:
+        # False implies everything.
+        # Everything implies True.
+        return True
+    if q.op == Query.QAll or r.op == Query.QNone:
+        # True implies nothing.
+        # Nothing implies False
+        return False
+    if q.op == Query.QAnd or (q.op == Query.QOr and len(q.trigram) == 1 and len(q.sub) == 0):
+        return trigramsImply(q.trigram, r)
+
+    if q.op == Query.QOr and r.op == Query.QOr and len(q.trigram) > 0 and len(q.sub) == 0 and isSubsetOf(q.trigram,
+                                                                                                         r.trigram):
+        return True
+    return False
+
+
+@lru_cache(maxsize=4096)
 def trigramsImply(t, q):
+    """
+    trigramsImply reports whether the AND of the trigrams t implies q.
+    t is a tuple, so the result is memoized like implies.
+    """
     if q.op == Query.QOr:
         for qq in q.sub:
             if trigramsImply(t, qq):
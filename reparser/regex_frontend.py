@@ -0,0 +1,245 @@
+import re
+import sys
+from copy import deepcopy
+from functools import lru_cache
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# The regex frontend: it parses with Python's own regex parser, so it
+# accepts exactly the syntax re.compile does, and converts the result to
+# the dict tree the requery modules consume, the same shape the ply
+# grammar in regex_parser builds:
+#
+#   {"type": "literal", "value": "abc"}
+#   {"type": "concat", "value": [x, y]}            binary, balanced
+#   {"type": "union", "value": [x, y]}             binary, balanced
+#   {"type": "repetition", "quantifier": "*", "value": x}
+#                                                   ?, *, +, {m}, {m,} or {m,n}
+#   {"type": "char_class", "value": "[a-z]", "chars": "ab...z"}
+#                                                   one character of a set; chars lists
+#                                                   them if there are at most MAX_CLASS_CHARS
+#   {"type": "ANY_CHAR"} or {"type": "ANY_CHAR_NOT_NL"}
+#   {"type": "BEGIN_LINE"}, {"type": "WORD_BOUNDARY"}, ... and {"type": "EMPTY_MATCH"}
+#                                                   match the empty string
+#
+# Groups are dropped, since the analyses don't care about captures.
+# Lookarounds become EMPTY_MATCH: like anchors they only restrict where
+# the regex matches, so the tree matches a superset of the regex.
+# Letters under IGNORECASE become char_class, as any of their cases match.
+# Concatenations and alternations of n nodes are balanced trees log n
+# deep, so that the analyses, which recurse over the tree, and copying
+# it handle alternations of thousands of words.
+
+ANCHORS = {sre_parse.AT_BEGINNING: "BEGIN_LINE", sre_parse.AT_END: "END_LINE",
+           sre_parse.AT_BEGINNING_STRING: "BEGIN_TEXT", sre_parse.AT_END_STRING: "END_TEXT",
+           sre_parse.AT_BOUNDARY: "WORD_BOUNDARY", sre_parse.AT_NON_BOUNDARY: "NO_WORD_BOUNDARY"}
+CATEGORIES = {sre_parse.CATEGORY_DIGIT: r"\d", sre_parse.CATEGORY_NOT_DIGIT: r"\D",
+              sre_parse.CATEGORY_WORD: r"\w", sre_parse.CATEGORY_NOT_WORD: r"\W",
+              sre_parse.CATEGORY_SPACE: r"\s", sre_parse.CATEGORY_NOT_SPACE: r"\S"}
+REPEATS = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, "POSSESSIVE_REPEAT", None)}
+GROUPS = {sre_parse.SUBPATTERN, getattr(sre_parse, "ATOMIC_GROUP", None)}
+# Larger classes are left without their list of characters.
+MAX_CLASS_CHARS = 100
+
+# The characters that have another case, computed on first use by cased.
+cased_chars = None
+
+
+@lru_cache(maxsize=256)
+def parse_cached(user_regex_query, flags):
+    try:
+        tree = sre_parse.parse(user_regex_query, flags)
+    except (re.error, TypeError):
+        return None
+    return convert(tree, tree.state.flags)
+
+
+def parse(user_regex_query, flags=0):
+    """
+    parse returns the dict tree of the regex compiled with flags, or None
+    if re can't parse it.  Trees are cached; each call gets its own copy,
+    which the caller is free to modify.
+    """
+    return deepcopy(parse_cached(user_regex_query, flags))
+
+
+def convert(tree, flags):
+    """
+    convert returns the dict tree of the sre_parse subpattern tree.
+    """
+    return concat([convert_node(op, av, flags) for op, av in tree])
+
+
+def convert_node(op, av, flags):
+    if op == sre_parse.LITERAL:
+        c = chr(av)
+        if flags & re.IGNORECASE and c.lower() != c.upper():
+            return char_class("[%s]" % re.escape(c), [(op, av)], flags)
+        return {"type": "literal", "value": c}
+    elif op == sre_parse.ANY:
+        return {"type": "ANY_CHAR" if flags & re.DOTALL else "ANY_CHAR_NOT_NL"}
+    elif op == sre_parse.IN:
+        return char_class(class_text(op, av), av, flags)
+    elif op in (sre_parse.NOT_LITERAL, sre_parse.CATEGORY):
+        return {"type": "char_class", "value": class_text(op, av)}
+    elif op == sre_parse.AT:
+        return {"type": ANCHORS.get(av, "EMPTY_MATCH")}
+    elif op == sre_parse.BRANCH:
+        return union([convert(sub, flags) for sub in av[1]])
+    elif op in GROUPS:
+        if op == sre_parse.SUBPATTERN:
+            _, add_flags, del_flags, av = av
+            flags = (flags | add_flags) & ~del_flags
+        return convert(av, flags)
+    elif op in REPEATS:
+        lo, hi, sub = av
+        return repetition(convert(sub, flags), lo, hi)
+    elif op == sre_parse.GROUPREF_EXISTS:
+        _, yes, no = av
+        return union([convert(yes, flags), convert(no, flags) if no else empty()])
+    elif op == sre_parse.GROUPREF:
+        # A backreference can match any text.
+        return repetition({"type": "ANY_CHAR"}, 0, sre_parse.MAXREPEAT)
+    # Lookarounds.
+    return {"type": "EMPTY_MATCH"}
+
+
+def empty():
+    return {"type": "literal", "value": ""}
+
+
+def concat(nodes):
+    """
+    concat returns the concatenation of the nodes, flattening nested
+    concatenations so adjacent literals can be merged.
+    """
+    flat = []
+    for node in nodes:
+        flatten(node, "concat", flat)
+    merged = []
+    for node in flat:
+        if node["type"] == "literal" and merged and merged[-1]["type"] == "literal":
+            merged[-1] = {"type": "literal", "value": merged[-1]["value"] + node["value"]}
+        else:
+            merged.append(node)
+    if not merged:
+        return empty()
+    return balanced("concat", merged)
+
+
+def union(nodes):
+    """
+    union returns the alternation of the nodes.
+    """
+    return balanced("union", nodes)
+
+
+def flatten(node, kind, out):
+    """
+    flatten appends to out the nodes that the tree of kind nodes at node
+    combines, in order.
+    """
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node["type"] == kind:
+            stack.extend(reversed(node["value"]))
+        else:
+            out.append(node)
+
+
+def balanced(kind, nodes):
+    """
+    balanced returns the binary tree of kind nodes combining nodes, in order,
+    split in halves so it is log(len(nodes)) deep.
+    """
+    if len(nodes) == 1:
+        return nodes[0]
+    mid = len(nodes) // 2
+    return {"type": kind, "value": [balanced(kind, nodes[:mid]), balanced(kind, nodes[mid:])]}
+
+
+def repetition(node, lo, hi):
+    """
+    repetition returns node repeated lo to hi times, hi being MAXREPEAT when unbounded.
+    """
+    if hi == 0:
+        return empty()
+    if lo == hi == 1:
+        return node
+    if hi == sre_parse.MAXREPEAT:
+        quantifier = {0: "*", 1: "+"}.get(lo, "{%d,}" % lo)
+    elif lo == hi:
+        quantifier = "{%d}" % lo
+    elif (lo, hi) == (0, 1):
+        quantifier = "?"
+    else:
+        quantifier = "{%d,%d}" % (lo, hi)
+    return {"type": "repetition", "quantifier": quantifier, "value": node}
+
+
+def char_class(text, items, flags):
+    """
+    char_class returns the char_class node of the IN items, listing the
+    characters it matches if they are few enough.
+    """
+    node = {"type": "char_class", "value": text}
+    chars = set()
+    for item_op, item_av in items:
+        if item_op == sre_parse.LITERAL:
+            chars.add(chr(item_av))
+        elif item_op == sre_parse.RANGE and item_av[1] - item_av[0] < MAX_CLASS_CHARS:
+            chars.update(map(chr, range(item_av[0], item_av[1] + 1)))
+        else:
+            # Negations, categories and large ranges.
+            return node
+    if flags & re.IGNORECASE and any(c.lower() != c.upper() for c in chars):
+        # Let re say which characters match, including odd ones like the Kelvin sign for k.
+        regex = re.compile(text, flags & (re.IGNORECASE | re.ASCII))
+        chars.update(regex.findall(cased()))
+    if len(chars) <= MAX_CLASS_CHARS:
+        node["chars"] = "".join(sorted(chars))
+    return node
+
+
+def cased():
+    """
+    cased returns a string of every character that has another case.
+    """
+    global cased_chars
+    if cased_chars is None:
+        cased_chars = "".join(c for c in map(chr, range(sys.maxunicode + 1)) if c.lower() != c or c.upper() != c)
+    return cased_chars
+
+
+def class_text(op, av):
+    """
+    class_text returns the source of a character class, for display.
+    """
+    if op == sre_parse.NOT_LITERAL:
+        return "[^%s]" % re.escape(chr(av))
+    if op == sre_parse.CATEGORY:
+        return CATEGORIES.get(av, "[]")
+    s = ""
+    for item_op, item_av in av:
+        if item_op == sre_parse.NEGATE:
+            s += "^"
+        elif item_op == sre_parse.LITERAL:
+            s += re.escape(chr(item_av))
+        elif item_op == sre_parse.RANGE:
+            s += "%s-%s" % (re.escape(chr(item_av[0])), re.escape(chr(item_av[1])))
+        elif item_op == sre_parse.CATEGORY:
+            s += CATEGORIES.get(item_av, "")
+    return "[%s]" % s
+
+
+if __name__ == "__main__":
+    from json import dumps
+    while True:
+        s = input()
+        if s == "quit":
+            break
+        print(dumps(parse(s), indent=2))
@@ -1,6 +1,9 @@
+import threading
+from copy import deepcopy
+from functools import lru_cache
 import ply.yacc as yacc
 # noinspection PyUnresolvedReferences
-from reparser.regex_lexer import tokens
+from reparser.regex_lexer import lexer, tokens
 
 
 # noinspection PySingleQuotedDocstring
@@ -84,10 +87,27 @@ def p_error(error):
     print("parse error:", error)
 
 
+# The parser is built once.  Its tables are cached in regex_parsetab.py
+# next to this file, so later runs load them instead of rebuilding them.
+parser = yacc.yacc(debug=False, tabmodule="regex_parsetab")
+# A ply parser keeps its state in the parser object.
+parser_lock = threading.Lock()
+
+
+@lru_cache(maxsize=256)
+def parse_cached(user_regex_query):
+    with parser_lock:
+        return parser.parse(user_regex_query, lexer=lexer.clone())
+
+
 def parse(user_regex_query):
-    parser = yacc.yacc()
-    return parser.parse(user_regex_query)
-    
+    """
+    parse returns the parse tree of the regex, or None if it can't be parsed.
+    Trees are cached by regex; each call gets its own copy, which the
+    caller is free to modify.
+    """
+    return deepcopy(parse_cached(user_regex_query))
+
 
 if __name__ == "__main__":
     print("hello")
@@ -1,5 +1,4 @@
-from copy import deepcopy
-from reparser.regex_parser import parse
+import tracing
 from query import Query, allQuery
 
 
@@ -20,6 +19,11 @@ def get_trigrams(raw_str):
 
 
 def freeQuery(tree):
+    with tracing.span("free"):
+        return analyze(tree)
+
+
+def analyze(tree):
     # if tree is None:
     #     return []
 
@@ -30,25 +34,26 @@ def freeQuery(tree):
         if len(trigram_list):
             return Query(o=Query.QAnd, trigram=trigram_list)
         else:
-            return deepcopy(allQuery)
+            return allQuery
 
     if re_type == "concat":
-        q = freeQuery(tree["value"][0])
-        r = freeQuery(tree["value"][1])
+        q = analyze(tree["value"][0])
+        r = analyze(tree["value"][1])
         return q.andOr(r, Query.QAnd)
         # return {"AND": [freeQuery(tree["value"][0]), freeQuery(tree["value"][1])]}
 
     if re_type == "union":
-        q = freeQuery(tree["value"][0])
-        r = freeQuery(tree["value"][1])
+        q = analyze(tree["value"][0])
+        r = analyze(tree["value"][1])
         return q.andOr(r, Query.QOr)
         # return {"OR": [freeQuery(tree["value"][0]), freeQuery(tree["value"][1])]}
 
-    if re_type == "repetition":
-        return deepcopy(allQuery)
+    # Repetitions, character classes and anchors.
+    return allQuery
 
 
 if __name__ == "__main__":
+    from reparser.regex_frontend import parse
     tests = [
         (r"(abcd|efgh)(ijklm|x*)", '("abc" "bcd")|("efg" "fgh")'),
         (r"(abc|cba)def", '("abc" | "cba") "def"'),
@@ -1,4 +1,4 @@
-from copy import deepcopy
+import tracing
 from query import Query, allQuery, noneQuery
 from stringset import add, clean, cross, have, minLen, size, union
 
@@ -7,9 +7,10 @@ def regexpQuery(re):
     """
     RegexpQuery returns a Query for the given regexp.
     """
-    info = analyze(re)
-    info.simplify(True)
-    info.addExact()
+    with tracing.span("gcs"):
+        info = analyze(re)
+        info.simplify(True)
+        info.addExact()
     return info.match
 
 
@@ -26,8 +27,12 @@ def analyze(re):
         return emptyString()
     elif re_type == "literal":
         info.exact = [re['value']]
-        info.match = deepcopy(allQuery)
-    elif re_type in {"ANY_CHAR_NOT_NL", "ANY_CHAR"}:
+        info.match = allQuery
+    elif re_type == "char_class" and 'chars' in re:
+        # A small class is the set of its characters.
+        info.exact = list(re['chars'])
+        info.match = allQuery
+    elif re_type in {"ANY_CHAR_NOT_NL", "ANY_CHAR", "char_class"}:
         return anyChar()
     elif re_type == "CAPTURE":
         return analyze(re['value'])
@@ -37,20 +42,34 @@ def analyze(re):
         return fold(alternate, re['value'], noMatch())
     elif re_type == "repetition":
         re_quantifier = re['quantifier']
+        lo, hi = repeatRange(re_quantifier)
         if re_quantifier == '?':
             return alternate(analyze(re['value']), emptyString())
-        elif re_quantifier == '+':
-            # x+
+        elif hi is not None and hi <= maxRepeat:
+            # x{m,n} is m copies of x followed by n-m copies of x?.
+            # x is analyzed once: analyzing every copy would take
+            # exponential time in the nesting of repetitions.
+            x = analyze(re['value'])
+            return concatAll([x.copy() for _ in range(lo)] +
+                             [alternate(x.copy(), emptyString()) for _ in range(hi - lo)])
+        elif lo == 0:
+            # x* or x{0,n}
+            # We don't know anything, so assume the worst.
+            return anyMatch()
+        else:
+            # x+ or x{m,}
             # Since there has to be at least one x, the prefixes and suffixes
             # stay the same.  If x was exact, it isn't anymore.
-            info = analyze(re['value'])
+            x = analyze(re['value'])
+            info = x.copy()
             if have(info.exact):
                 info.prefix = info.exact
-                info.suffix = deepcopy(info.exact)
+                info.suffix = list(info.exact)
                 info.exact = []
-        elif re_quantifier == '*':
-            # We don't know anything, so assume the worst.
-            return anyMatch()
+            # x{m,} is m-1 copies of x followed by x+.
+            if lo > 1:
+                info.simplify(False)
+                info = concat(concatAll([x.copy() for _ in range(min(lo, maxRepeat) - 1)]), info)
     elif re_type == "REPEAT":
         try:
             if re['min'] == 0:
@@ -59,7 +78,106 @@ def analyze(re):
             pass
 
     info.simplify(False)
-    return deepcopy(info)
+    return info
+
+
+def repeatRange(quantifier):
+    """
+    repeatRange returns the least and the most number of repetitions a
+    quantifier allows: one of ?, *, +, {m}, {m,} and {m,n}.
+    The most is None if there is no limit.
+    """
+    if quantifier in ('?', '*', '+'):
+        return {'?': (0, 1), '*': (0, None), '+': (1, None)}[quantifier]
+    bounds = quantifier[1:-1].split(',')
+    lo = int(bounds[0])
+    if len(bounds) == 1:
+        return lo, lo
+    return lo, int(bounds[1]) if bounds[1] else None
+
+
+def requiredLiterals(re):
+    """
+    requiredLiterals returns a list of strings at least one of which
+    occurs in every match of the regexp re, or None if there is no such list.
+    Unlike the prefix and suffix sets of a regexpInfo, the strings are not
+    cut down to trigram size, so they can be searched for before running the regexp.
+    """
+    if re is None:
+        return None
+    s, _ = required(re)
+    if s is None or minLen(s) == 0:
+        return None
+    # A string containing another one of the set adds nothing.
+    return [x for x in s if not any(y != x and y in x for y in s)]
+
+
+def required(re):
+    """
+    required returns (s, exact) for the regexp re.  If exact, every match
+    of re is one of the strings in s; otherwise every match contains one of them.
+    s is None when no string is known to be required.
+    """
+    re_type = re['type']
+    if re_type in {"EMPTY_MATCH", "BEGIN_LINE", "END_LINE", "BEGIN_TEXT", "END_TEXT", "WORD_BOUNDARY",
+                   "NO_WORD_BOUNDARY"}:
+        return [''], True
+    elif re_type == "char_class" and 'chars' in re:
+        return list(re['chars']), True
+    elif re_type == "literal":
+        # The parser turns . into ω, which splits the literal.
+        pieces = re['value'].split('ω')
+        if len(pieces) == 1:
+            return [re['value']], True
+        best = max(pieces, key=len)
+        return ([best] if best else None), False
+    elif re_type == "CAPTURE":
+        return required(re['value'])
+    elif re_type in {"concat", "union"}:
+        f = requiredConcat if re_type == "concat" else requiredAlternate
+        info = required(re['value'][0])
+        for sub in re['value'][1:]:
+            info = f(info, required(sub))
+        return info
+    elif re_type == "repetition":
+        s, exact = required(re['value'])
+        if s is None:
+            return None, False
+        lo, hi = repeatRange(re['quantifier'])
+        if exact and hi is not None and hi <= maxRepeat:
+            # Like analyze, x{m,n} is m copies of x followed by n-m copies of x?.
+            info = [''], True
+            for k in range(hi):
+                info = requiredConcat(info, (s if k < lo else union(s, [''], False), True))
+            return info
+        if lo > 0:
+            return s, False
+    return None, False
+
+
+def requiredConcat(x, y):
+    """
+    requiredConcat returns the required strings of xy given those of x and y.
+    """
+    xs, xExact = x
+    ys, yExact = y
+    if xExact and yExact and size(xs) * size(ys) <= maxSet:
+        return cross(xs, ys, False), True
+    # Either side's strings are still required; keep the longer, then fewer ones.
+    if xs is None or (ys is not None and (minLen(ys), -size(ys)) > (minLen(xs), -size(xs))):
+        return ys, False
+    return xs, False
+
+
+def requiredAlternate(x, y):
+    """
+    requiredAlternate returns the required strings of x|y given those of x and y.
+    """
+    xs, xExact = x
+    ys, yExact = y
+    if xs is None or ys is None or size(xs) + size(ys) > maxSet:
+        return None, False
+    return union(xs, ys, False), xExact and yExact
 
 
 def fold(f, sub, zero):
@@ -67,13 +185,26 @@ def fold(f, sub, zero):
     fold is the usual higher-order function.
     """
     if len(sub) == 0:
-        return deepcopy(zero)
+        return zero
     elif len(sub) == 1:
         return analyze(sub[0])
     info = f(analyze(sub[0]), analyze(sub[1]))
     for i in range(2, len(sub)):
         info = f(info, analyze(sub[i]))
-    return deepcopy(info)
+    return info
+
+
+def concatAll(infos):
+    """
+    concatAll returns the regexpInfo for the concatenation of the
+    regexps analyzed as infos, like fold(concat, ...) does for regexps.
+    """
+    if len(infos) == 0:
+        return emptyString()
+    info = infos[0]
+    for x in infos[1:]:
+        info = concat(info, x)
+    return info
 
 
 # Exact sets are limited to maxExact strings.
@@ -86,6 +217,11 @@ def fold(f, sub, zero):
 # triggers a flush.
 maxExact = 7
 
+# Repetitions x{m,n} are expanded into copies of x when n is at most
+# maxRepeat.  Larger counts are analyzed as x{maxRepeat,} or x*, which
+# match more.
+maxRepeat = 8
+
 # Prefix and suffix sets are limited to maxSet strings.
 # If they get too big, simplify will replace groups of strings
 # sharing a common leading prefix (or trailing suffix) with
@@ -100,6 +236,7 @@ class RegexpInfo(object):
     """
     A regexpInfo summarizes the results of analyzing a regexp.
     """
+    __slots__ = ("canEmpty", "exact", "prefix", "suffix", "match")
 
     def __init__(self, canEmpty=False, exact=None, prefix=None, suffix=None, match=None):
         self.canEmpty = canEmpty
@@ -108,6 +245,13 @@ class RegexpInfo(object):
         self.suffix = [] if suffix is None else suffix
         self.match = match
 
+    def copy(self):
+        """
+        copy returns a copy of the regexpInfo.  concat, alternate and
+        simplify modify the regexpInfos they are given.
+        """
+        return RegexpInfo(self.canEmpty, list(self.exact), list(self.prefix), list(self.suffix), self.match)
+
     def addExact(self):
         """
         addExact adds to the match query the trigrams for matching info.exact.
@@ -206,7 +350,7 @@ def anyMatch():
         canEmpty=True,
         prefix=[''],
         suffix=[''],
-        match=deepcopy(allQuery)
+        match=allQuery
     )
 
 
@@ -218,7 +362,7 @@ def anyChar():
     return RegexpInfo(
         prefix=[''],
         suffix=[''],
-        match=deepcopy(allQuery)
+        match=allQuery
     )
 
 
@@ -228,7 +372,7 @@ def noMatch():
     matches no strings at all.
     """
     return RegexpInfo(
-        match=deepcopy(noneQuery)
+        match=noneQuery
     )
 
 
@@ -240,7 +384,7 @@ def emptyString():
     return RegexpInfo(
         canEmpty=True,
         exact=[''],
-        match=deepcopy(allQuery)
+        match=allQuery
     )
 
 
@@ -277,7 +421,7 @@ def concat(x, y):
         xy.match = xy.match.andTrigrams(cross(x.suffix, y.prefix, False))
 
     xy.simplify(False)
-    return deepcopy(xy)
+    return xy
 
 
 def alternate(x, y):
@@ -294,7 +438,7 @@ def alternate(x, y):
         x.addExact()
     elif have(y.exact):
         xy.prefix = union(x.prefix, y.exact, False)
-        xy.suffix = union(x.suffix, deepcopy(y.exact), True)
+        xy.suffix = union(x.suffix, y.exact, True)
         y.addExact()
     else:
         xy.prefix = union(x.prefix, y.prefix, False)
@@ -303,7 +447,7 @@ def alternate(x, y):
     xy.match = x.match.q_or(y.match)
 
     xy.simplify(False)
-    return deepcopy(xy)
+    return xy
 
 
 if __name__ == "__main__":
@@ -1,127 +1,146 @@
-import re
 import logging
-from copy import deepcopy
-from reparser.regex_parser import parse
+import tracing
 from query import Query, allQuery
+from requery.gcs import maxRepeat, repeatRange
+from stringset import clean
 
+# Nodes matching the empty string.
+EMPTY_TYPES = {"EMPTY_MATCH", "BEGIN_LINE", "END_LINE", "BEGIN_TEXT", "END_TEXT", "WORD_BOUNDARY",
+               "NO_WORD_BOUNDARY"}
 
-def cross(s, t):
-    return {x + y for x in s for y in t}
-
-
-def repeat(s):
-    return s | {x + x for x in s}
-
-
-def convert(parse_tree: dict):
-    if parse_tree["type"] == "repetition":
-        modifier_list = ["?"]
-        q = "".join(parse_tree["quantifier"].split())
-        if q == "*":  # e* -> e?e?
-            modifier_list = ["?", "?"]
-
-        elif q == "+":  # e+ -> ee?
-            # parse_tree = modify_parse_tree(parse_tree, ["e", "?"])
-            modifier_list = ["e", "?"]
-
-        elif re.fullmatch(r"^{\d+}$", q):  # e{m} -> e * min(m,3)
-            m, = map(int, re.findall(r"\d+", q))
-            modifier_list = ["e"]*min(m, 3)
+# String sets are limited to MAX_STRINGS strings.  A concatenation or
+# alternation that would make a larger one first adds the trigrams of its
+# operands to the match query, then cuts the middle out of their strings
+# (see shorten) until the set is small enough.  Cutting loses trigrams,
+# never matches, so queries get weaker, not wrong, and every step stays cheap.
+MAX_STRINGS = 64
 
-        elif re.fullmatch(r"^{\d+,}$", q):
-            m, = map(int, re.findall(r"\d+", q))
-            modifier_list = ["e"]*min(m, 3) + ["?"]*max(0, 3-m)
+# Strings are the text of a match, with ω standing for any text.
+# A trigram is only taken from three characters none of which is ω.
+ANY = "ω"
 
-        elif re.fullmatch(r"^{\d+,\d+}$", q):
-            m, n = map(int, re.findall(r"\d+", q))
-            modifier_list = ["e"] * min(m, 3) + ["?"] * min(n-m, 3-min(m, 3))
 
-        new_node = modify_parse_tree(parse_tree, modifier_list)
-        parse_tree.clear()
-        parse_tree.update(new_node)
+def cross(s, t):
+    return {x + y for x in s for y in t}
 
-    elif parse_tree["type"] == "char_class":
-        parse_tree["type"] = "literal"
-        parse_tree["value"] = "ω"
 
-    if type(parse_tree["value"]) == list:
-        for sub_tree in parse_tree["value"]:
-            convert(sub_tree)
-    elif type(parse_tree["value"]) == dict:
-        convert(parse_tree["value"])
+def shorten(strings, n):
+    """
+    shorten replaces all but the first and last n characters of each
+    string with ω.
+    """
+    return {x if len(x) <= 2 * n else x[:n] + ANY + x[len(x) - n:] for x in strings}
 
 
-def modify_parse_tree(root: dict, modifier_list: list) -> dict:
+def strings_query(strings):
+    """
+    strings_query returns the OR over strings of the AND of their trigrams.
+    A string without trigrams makes it match everything.
+    """
+    sub = []
+    for tt in strings:
+        trig = [tt[i:i + 3] for i in range(len(tt) - 2) if ANY not in tt[i:i + 3]]
+        if not trig:
+            return allQuery
+        clean(trig, False)
+        sub.append(Query(Query.QAnd, trig))
+    if not sub:
+        return allQuery
+    # Queries are interned, so equal ones are the same object.
+    return Query(Query.QOr, sub=list(dict.fromkeys(sub)))
+
+
+def concat(x, y):
     """
-    Recursively modifies the parse tree based on the list.
-    modifier_list = ['e', 'e', '?'] if the expression e at root should be modified
-    to {concat : {e, concat: {e, {repetition: '?', value: e}}}}
-    :param root: root node of the parse tree
-    :param modifier_list: list with instructions
-    :return: new root
+    concat returns (match, strings) for xy given those of x and y.
     """
-    assert modifier_list
-    if len(modifier_list) == 1:
-        if modifier_list[0] == "?":
-            return {
-                "type": "repetition",
-                "quantifier": "?",
-                "value": deepcopy(root["value"])
-            }
-        else:
-            return deepcopy(root["value"])
-    else:
-        return {
-            "type": "concat",
-            "value": [
-                modify_parse_tree(root, modifier_list[:1]),
-                modify_parse_tree(root, modifier_list[1:])
-            ]
-        }
+    xm, xs = x
+    ym, ys = y
+    match = xm.q_and(ym)
+    n = 2
+    while len(xs) * len(ys) > MAX_STRINGS:
+        if n == 2:
+            match = match.q_and(strings_query(xs)).q_and(strings_query(ys))
+        xs, ys = shorten(xs, n), shorten(ys, n)
+        n -= 1
+    return match, cross(xs, ys)
+
+
+def alternate(x, y):
+    """
+    alternate returns (match, strings) for x|y given those of x and y.
+    """
+    xm, xs = x
+    ym, ys = y
+    strings = xs | ys
+    if len(strings) <= MAX_STRINGS:
+        return xm.q_or(ym), strings
+    match = xm.q_and(strings_query(xs)).q_or(ym.q_and(strings_query(ys)))
+    n = 2
+    while len(strings) > MAX_STRINGS:
+        strings = shorten(strings, n)
+        n -= 1
+    return match, strings
+
+
+def repeat(x, lo, hi):
+    """
+    repeat returns (match, strings) for x{lo,hi} given those of x; hi is
+    None if there is no limit.  Up to maxRepeat copies are spelled out;
+    more are summarized as the first copies and the last one with any
+    text in between.
+    """
+    bounded = hi is not None and hi <= maxRepeat
+    top = hi if bounded else max(min(lo, maxRepeat), 2)
+    info = None
+    power = prev = allQuery, {""}
+    for k in range(top + 1):
+        if k:
+            prev, power = power, concat(power, x)
+        if k == top and not bounded:
+            power = concat(concat(prev, (allQuery, {ANY})), x)
+        if k >= min(lo, top):
+            info = power if info is None else alternate(info, power)
+    return info
 
 
 def analyze(tree):
-    if tree is None:
-        return set()
-
+    """
+    analyze returns (match, strings) for the parse tree: every match of
+    the regex is one of the strings and satisfies the match query.
+    """
     re_type = tree["type"]
-
     if re_type == "literal":
-        return {tree["value"]}
-
-    if re_type == "concat":
-        return cross(analyze(tree["value"][0]), analyze(tree["value"][1]))
-
-    if re_type == "union":
-        return analyze(tree["value"][0]) | analyze(tree["value"][1])
-
-    if re_type == "repetition":
-        re_quantifier = tree["quantifier"]
-        assert re_quantifier == "?"  # after transformation the regex must have only ?
-        s = analyze(tree["value"])
-        s.add('')
-        return s
+        return allQuery, {tree["value"]}
+    elif re_type == "char_class" and len(tree.get("chars", "")) in range(1, MAX_STRINGS + 1):
+        return allQuery, set(tree["chars"])
+    elif re_type in EMPTY_TYPES:
+        return allQuery, {""}
+    elif re_type == "CAPTURE":
+        return analyze(tree["value"])
+    elif re_type in ("concat", "union"):
+        f = concat if re_type == "concat" else alternate
+        info = analyze(tree["value"][0])
+        for sub in tree["value"][1:]:
+            info = f(info, analyze(sub))
+        return info
+    elif re_type == "repetition":
+        return repeat(analyze(tree["value"]), *repeatRange("".join(tree["quantifier"].split())))
+    # Single characters of large classes, and anything else.
+    return allQuery, {ANY}
 
 
 def regexp_query(tree):
-    convert(tree)
-    string_set = analyze(tree)
+    if tree is None:
+        return allQuery
+    with tracing.span("reset"):
+        match, string_set = analyze(tree)
     logging.info("analyze identified string set: %s", str(string_set))
-    sub = []
-    for tt in string_set:
-        trig = []
-        for i in range(0, len(tt) - 2):
-            if 'ω' not in tt[i:i + 3]:
-                trig.append(tt[i:i + 3])
-        if len(trig):
-            sub.append(Query(Query.QAnd, trig))
-    q = Query(Query.QOr, sub=sub)
-    if len(sub) == 0:
-        q = allQuery
-    return q
+    return match.q_and(strings_query(string_set))
 
 
 if __name__ == "__main__":
+    from reparser.regex_frontend import parse
 
     tests = [
         (r'Abcdef', '"Abc" "bcd" "cde" "def"'),
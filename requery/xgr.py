@@ -1,33 +1,92 @@
+import tracing
+from multiprocessing import Pool
 from xeger import Xeger
-from collections import Counter
-from query import Query
+from query import Query, allQuery
+
+# Sample i is drawn with seed SEED + i, so a regex always gets the same
+# samples, in the same order, however many processes draw them.
+SEED = 1
+
+# Sampling stops once the trigrams common to all samples so far have not
+# changed for STABLE samples, or after MAX_SAMPLES samples.
+STABLE = 20
+MAX_SAMPLES = 999
+
+# Queries already inferred, by (regex, seed, stable); at most MAX_CACHED.
+cache = {}
+MAX_CACHED = 256
 
 
 def get_trigrams(raw_str):
     prev = raw_str[:3]
-    yield prev
+    if len(prev) == 3:
+        yield prev
     for j in range(3, len(raw_str)):
         prev = prev[1:] + raw_str[j]
         yield prev
 
 
-def xegerQuery(query):
-    c = Counter()
-    total = 0
-    
-    for i in range(1, min(4**len(query), 1000)):
-        x = Xeger(limit=i)
-        res = x.xeger(query)
-        total += 1
-        trigrams = list(set(get_trigrams(res)))
-        c.update(trigrams)
+def sample_trigrams(job):
+    """
+    sample_trigrams returns the set of trigrams of sample i of the regex,
+    drawn with repetitions of at most i.
+    """
+    query, i, seed = job
+    x = Xeger(limit=i, seed=seed + i)
+    return set(get_trigrams(x.xeger(query)))
+
+
+def samples(query, seed, jobs):
+    """
+    samples yields the trigram sets of samples 1, 2, ... of the regex in order.
+    With jobs > 1 they are drawn by a pool of jobs processes, a batch at a time.
+    """
+    n = min(4 ** len(query), MAX_SAMPLES + 1) - 1
+    if jobs <= 1:
+        for i in range(1, n + 1):
+            yield sample_trigrams((query, i, seed))
+        return
+    with Pool(jobs) as pool:
+        batch = 4 * jobs
+        for start in range(1, n + 1, batch):
+            todo = [(query, i, seed) for i in range(start, min(start + batch, n + 1))]
+            yield from pool.map(sample_trigrams, todo)
+
+
+def xegerQuery(query, jobs=1, seed=SEED, stable=STABLE):
+    """
+    xegerQuery returns the AND of the trigrams found in every sample of
+    the regex drawn by xeger.  Samples are seeded, so the query is the same
+    on every run, and drawing stops once the common trigrams are stable.
+    Queries are memoized by regex.
+    """
+    key = (query, seed, stable)
+    q = cache.get(key)
+    if q is not None:
+        return q
 
-    tri = list(filter(lambda t: c[t] == total, c.keys()))
+    common = None
+    unchanged = 0
+    with tracing.span("xeger"):
+        gen = samples(query, seed, jobs)
+        for trigrams in gen:
+            tracing.count("xeger_samples")
+            if common is not None and trigrams >= common:
+                unchanged += 1
+            else:
+                common = trigrams if common is None else common & trigrams
+                unchanged = 0
+            if not common or unchanged >= stable:
+                break
+        gen.close()
 
-    if len(tri) == 0:
-        q = Query(Query.QAll)       
+    if not common:
+        q = allQuery
     else:
-        q = Query(Query.QAnd, trigram=tri)
+        q = Query(Query.QAnd, trigram=sorted(common))
+    if len(cache) >= MAX_CACHED:
+        del cache[next(iter(cache))]
+    cache[key] = q
     return q
 
 
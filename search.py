@@ -0,0 +1,80 @@
+import tracing
+from time import time
+from query import allQuery
+from requery.gcs import regexpQuery, requiredLiterals
+from requery.reset import regexp_query
+from requery.xgr import xegerQuery
+from requery.free import freeQuery
+from reparser.regex_frontend import parse
+
+# Builders of the trigram query of each algorithm, from the parse tree
+# or, for xeger, from the regex itself, sampled by jobs processes.
+ALGORITHMS = {'bruteforce': lambda regex, tree, jobs: allQuery,
+              'gcs': lambda regex, tree, jobs: regexpQuery(tree),
+              'reset': lambda regex, tree, jobs: regexp_query(tree),
+              'xeger': lambda regex, tree, jobs: xegerQuery(regex, jobs),
+              'free': lambda regex, tree, jobs: freeQuery(tree)}
+
+
+# The algorithms auto chooses from, cheapest to build first.  Once
+# building queries has taken AUTO_BUDGET seconds, the rest are skipped.
+AUTO = ['gcs', 'free', 'reset']
+AUTO_BUDGET = 0.05
+
+
+def build_query(algo, regex, tree=None, jobs=1):
+    """
+    build_query returns the trigram query of regex built by algo.
+    tree is the parse tree of regex; it is parsed if not given.
+    """
+    if tree is None and algo not in ('bruteforce', 'xeger'):
+        with tracing.span("parse"):
+            tree = parse(regex)
+    with tracing.span("query"):
+        return ALGORITHMS[algo](regex, tree, jobs)
+
+
+def auto_query(index, regex, tree=None):
+    """
+    auto_query builds the queries of the AUTO algorithms and returns the
+    name and query of the one with the fewest estimated candidates in
+    index, and the estimates of all the ones built.
+    Candidates are estimated from posting list lengths, without evaluating
+    the queries.  The first algorithm wins ties.
+    """
+    if tree is None:
+        tree = parse(regex)
+    st = time()
+    best = None
+    estimates = {}
+    for algo in AUTO:
+        if estimates and time() - st > AUTO_BUDGET:
+            break
+        query = build_query(algo, regex, tree)
+        estimates[algo] = index.get_estimate(query)
+        if best is None or estimates[algo] < estimates[best[0]]:
+            best = algo, query
+    return best[0], best[1], estimates
+
+
+def required_literals(tree):
+    """
+    required_literals returns strings one of which is in every match of
+    the regex parsed as tree, or None.
+    """
+    return requiredLiterals(tree)
+
+
+def candidate_files(index, query, candid, blocks=False):
+    """
+    candidate_files yields the names of the candidate files as the lazy
+    plan finds them, so verification starts before all of them are known.
+    Their ids are appended to candid.  With blocks, a file whose matches
+    can only be in some of its blocks is yielded as a (name, regions) pair
+    instead, see Index.candidate_regions; the regex must be single_line.
+    """
+    for fileid in index.iter_candidate_fileids(query):
+        candid.append(fileid)
+        tracing.count("candidates")
+        regions = index.candidate_regions(fileid, query) if blocks else None
+        yield index.files[fileid] if regions is None else (index.files[fileid], regions)
@@ -1,6 +1,3 @@
-from copy import deepcopy
-
-
 # A stringSet is a set of strings.
 # The nil stringSet indicates not having a set.
 # The non-nil but empty stringSet is the empty set.
@@ -55,11 +52,11 @@ def minLen(s):
 
 def union(s, t, isSuffix):
     """
-    union returns the union of s and t, reusing s's storage.
+    union returns the union of s and t as a new list.
     """
-    s = s + t
+    s = list(s) + list(t)
     clean(s, isSuffix)
-    return deepcopy(s)
+    return s
 
 
 def cross(s, t, isSuffix):
@@ -0,0 +1,23 @@
+import csearchd
+from csearchd import Searcher
+from index import Index
+
+
+def test_searcher(tmp_path, monkeypatch):
+    root = tmp_path / "src"
+    root.mkdir()
+    (root / "a.py").write_text("def hello_world():\n    pass\n")
+    (root / "b.py").write_text("print('hello')\n")
+    index_file = str(tmp_path / "other.idx")
+    Index(str(root), index_file=index_file)
+    searcher = Searcher(index_file)
+    messages = list(searcher.answer({"regex": "hello_wor+ld"}))
+    assert messages[0] == {"file": str(root / "a.py")}
+    assert messages[-1]["done"] and messages[-1]["matches"] == 1
+
+    def fail(*args):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(csearchd, "build_query", fail)
+    messages = list(searcher.answer({"regex": "hello"}))
+    assert messages == [{"error": "search failed: boom"}]
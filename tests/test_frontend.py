@@ -0,0 +1,44 @@
+import os
+import random
+import subprocess
+import sys
+import pytest
+from reparser.regex_frontend import parse
+from search import build_query
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def depth(node):
+    value = node.get("value")
+    if isinstance(value, list):
+        return 1 + max(depth(sub) for sub in value)
+    if isinstance(value, dict):
+        return 1 + depth(value)
+    return 1
+
+
+@pytest.mark.parametrize("n", [400, 2000])
+def test_long_alternation(n):
+    rng = random.Random(n)
+    words = sorted({"".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(6)) for _ in range(n)})
+    regex = "|".join(words)
+    tree = parse(regex)
+    assert depth(tree) <= 2 * n.bit_length()
+    for algo in ("gcs", "reset", "free"):
+        query = str(build_query(algo, regex, parse(regex)))
+        assert '"%s"' % words[0][:3] in query and '"%s"' % words[-1][-3:] in query
+
+
+def test_long_concatenation():
+    regex = "".join("%s[xy]" % chr(ord("a") + i % 26) for i in range(1000))
+    assert depth(parse(regex)) <= 30
+    for algo in ("gcs", "reset", "free"):
+        build_query(algo, regex, parse(regex))
+
+
+def test_search_doesnt_build_ply_parser():
+    # The ply grammar is only for the requery modules' self-tests.
+    code = "import sys, search; print(any(m.startswith(('ply', 'reparser.regex_parser')) for m in sys.modules))"
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == "False"
@@ -0,0 +1,21 @@
+import time
+from reparser.regex_frontend import parse
+from requery.gcs import regexpQuery
+
+
+def query(regex):
+    return str(regexpQuery(parse(regex)))
+
+
+def test_bounded_repeat():
+    assert set(query(r"(abc){2}").split()) == {'"abc"', '"bca"', '"cab"'}
+    assert query(r"x(abc)?y") == query(r"x(abc|)y")
+
+
+def test_nested_bounded_repeat():
+    # Each level used to analyze its subexpression once per copy,
+    # taking seconds at this depth.
+    st = time.time()
+    assert query(r"((((((a{2,8}){2,8}){2,8}){2,8}){2,8}){2,8})") == '"aaa"'
+    query(r"((((((ab{1,8}){1,8}){1,8}){1,8}){1,8}){1,8})")
+    assert time.time() - st < 1
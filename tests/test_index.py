@@ -0,0 +1,105 @@
+import logging
+import os
+import re
+from index import Index
+from query import allQuery
+from search import build_query, candidate_files
+from verify import search_files
+
+
+def write(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def blocks_by_name(index):
+    out = {}
+    for i, name in enumerate(index.files):
+        if i not in index.deleted:
+            fblocks = index.index.blocks(i)
+            out[name] = None if fblocks is None else (fblocks.starts(), dict(fblocks.items()))
+    return out
+
+
+def test_update_block_index(tmp_path):
+    root = tmp_path / "src"
+    root.mkdir()
+    lines = ["def f%d(x):\n    return x + %d\n" % (i, i) for i in range(40)]
+    write(root / "a.py", "".join(lines))
+    write(root / "b.py", "".join(reversed(lines)))
+    write(root / "c.py", "short\n")
+    index_file = str(tmp_path / "index.idx")
+    Index(str(root), index_file=index_file, block_size=64)
+
+    write(root / "b.py", "".join(lines[:10]) + "def changed():\n    pass\n")
+    os.remove(root / "c.py")
+    write(root / "d.py", "".join(lines[20:]))
+    updated = Index(index_file=index_file)
+    updated.update(str(root))
+    assert updated.block_size == 64
+
+    fresh = Index(str(root), index_file=str(tmp_path / "fresh.idx"), block_size=64)
+    assert blocks_by_name(updated) == blocks_by_name(fresh)
+
+    updated.compact()
+    assert blocks_by_name(updated) == blocks_by_name(fresh)
+    fileid = list(updated.files).index(str(root / "b.py"))
+    regions = updated.candidate_regions(fileid, allQuery.andTrigrams(["changed"]))
+    data = open(root / "b.py").read()
+    assert regions and all(end is None or end < len(data) for _, end in regions)
+    assert any("changed" in data[start:end] for start, end in regions)
+
+
+def test_memory_budget(tmp_path):
+    root = tmp_path / "src"
+    for d in range(3):
+        (root / str(d)).mkdir(parents=True)
+        for i in range(20):
+            write(root / str(d) / ("f%d.py" % i), "".join("x_%d_%d = %d\n" % (d, i, k) for k in range(i * 5)))
+    ref = tmp_path / "ref.idx"
+    Index(str(root), index_file=str(ref), block_size=64)
+    for workers in (1, 3):
+        out = tmp_path / ("budget%d.idx" % workers)
+        Index(str(root), workers, index_file=str(out), block_size=64, memory_budget=4096)
+        assert out.read_bytes() == ref.read_bytes()
+    assert not [p for p in os.listdir(tmp_path) if p.startswith("csidx-")]
+
+
+def test_latin1_file(tmp_path):
+    root = tmp_path / "src"
+    root.mkdir()
+    (root / "latin1.txt").write_bytes("café au lait\n".encode("latin-1"))
+    write(root / "other.txt", "tea\n")
+    index = Index(str(root), index_file=str(tmp_path / "index.idx"))
+    assert index.get_filecount() == 2
+    regex = re.compile(r"au lait")
+    names = list(candidate_files(index, build_query("gcs", regex.pattern), []))
+    assert names == [str(root / "latin1.txt")]
+    for threshold in (None, 0):
+        assert list(search_files(regex, names, threshold)) == names
+
+
+def test_update_skipped_files(tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    root = tmp_path / "src"
+    root.mkdir()
+    write(root / "small.txt", "small\n")
+    write(root / "large.txt", "large\n" * 100)
+    index_file = str(tmp_path / "index.idx")
+    Index(str(root), index_file=index_file, max_file_size=100)
+    for _ in range(2):
+        caplog.clear()
+        index = Index(index_file=index_file, max_file_size=100)
+        index.update(str(root))
+        assert "0 added, 0 changed, 0 deleted" in caplog.text
+        assert "skipped" not in caplog.text
+        assert list(index.files) == [str(root / "small.txt")]
+        assert list(index.index.skipped()) == [str(root / "large.txt")]
+    write(root / "large.txt", "larger\n" * 100)
+    caplog.clear()
+    Index(index_file=index_file, max_file_size=100).update(str(root))
+    assert "0 added" in caplog.text and "skipped 1 files larger" in caplog.text
+    index = Index(index_file=index_file)
+    index.update(str(root))
+    assert list(index.files) == [str(root / "small.txt"), str(root / "large.txt")]
+    assert not index.index.skipped()
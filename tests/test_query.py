@@ -0,0 +1,11 @@
+import pickle
+from query import Query
+
+
+def test_interning_ignores_order():
+    abc, xyz = Query(Query.QAnd, ["abc", "bcd"]), Query(Query.QAnd, ["xyz"])
+    assert Query(Query.QAnd, ["bcd", "abc", "bcd"]) is abc
+    assert Query(Query.QOr, ["def", "abc"], [abc, xyz]) is Query(Query.QOr, ["abc", "def", "abc"], [xyz, abc, xyz])
+    assert abc.q_or(xyz) is xyz.q_or(abc)
+    assert str(Query(Query.QOr, sub=[xyz, abc])) == '("abc" "bcd")|("xyz")'
+    assert pickle.loads(pickle.dumps(abc.q_or(xyz))) is abc.q_or(xyz)
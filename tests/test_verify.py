@@ -0,0 +1,47 @@
+import re
+import pytest
+from verify import bytes_pattern, iter_matches, search_files, search_regions
+
+
+@pytest.fixture
+def files(tmp_path):
+    names = {}
+    for name, data in [("crlf.txt", b"hello world\r\nfoo bar baz\r\nend\r\n"),
+                       ("cr.txt", b"hello world\rfoo bar baz\r"),
+                       ("kelvin.txt", "temperature in Kelvin\n".encode()),
+                       ("cafe.txt", "café au lait\n".encode())]:
+        path = tmp_path / name
+        path.write_bytes(data)
+        names[name] = str(path)
+    return names
+
+
+@pytest.mark.parametrize("regex", [r"(?m)bar baz$", r"hello world\nfoo", r"(?m)^foo", r"(?i)kelvin", r"(?i:KELVIN)",
+                                   r"caf.", r"caf\w", r"caf\b", r"lait$", r"f[^x] au", r"caf.* au"])
+def test_bytes_mode_matches_text_mode(files, regex):
+    names = sorted(files.values())
+    compiled = re.compile(regex)
+    text = list(search_files(compiled, names))
+    for threshold in (0, 1 << 20):
+        assert list(search_files(compiled, names, threshold)) == text
+        assert [m.file for m in iter_matches(compiled, names, threshold)] == \
+            [m.file for m in iter_matches(compiled, names)]
+
+
+def test_crlf_and_case_folding(files):
+    names = sorted(files.values())
+    for regex in [r"(?m)bar baz$", r"hello world\nfoo"]:
+        assert list(search_files(re.compile(regex), names, 0)) == [files["cr.txt"], files["crlf.txt"]]
+    assert list(search_files(re.compile(r"(?i)kelvin"), names, 0)) == [files["kelvin.txt"]]
+
+
+def test_bytes_pattern():
+    assert bytes_pattern(re.compile(r"foo.*bar")) is not None
+    assert bytes_pattern(re.compile(r"[a-z_]+\(")) is not None
+    for regex in [r"(?i)foo", r"foo.bar", r"\w+", r"\bfoo", r"[^a]b", r"\s*x", r"café"]:
+        assert bytes_pattern(re.compile(regex)) is None
+
+
+def test_regions_crlf(files):
+    assert search_regions(re.compile(rb"(?m)bar baz$"), files["crlf.txt"], [(13, None)])
+    assert search_regions(re.compile(r"(?m)bar baz$"), files["crlf.txt"], [(13, None)])
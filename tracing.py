@@ -0,0 +1,159 @@
+import threading
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+
+# Instrumentation of a search.  Code marks the stages it runs with
+#
+#   with tracing.span("verify"):
+#       ...
+#
+# and adds up quantities with tracing.count("bytes_read", n).  Both go to
+# the current tracer, which by default is NULL and does nothing, so the
+# hooks cost a function call when tracing is off.  To trace, install a
+# Tracer:
+#
+#   tracer = tracing.Tracer()
+#   with tracing.using(tracer):
+#       ...
+#   tracer.report()
+#
+# Spans of the same name are aggregated into a count and their total and
+# longest seconds.  Spans nest, so a span's time includes that of the spans
+# run inside it.
+#
+# Spans:
+#   parse          regex to parse tree (csearch)
+#   query          parse tree to trigram query (search.build_query)
+#   gcs, reset, free, xeger
+#                  the analysis of each requery builder
+#   index_load     mapping the index file
+#   eval           evaluation of one AND or OR node of a query
+#   compile        compilation of a query into a lazy plan
+#   postings       decoding of the posting list of a trigram
+#   read           opening and reading (or mapping) a candidate file
+#   regex          running the regex (and prefilter) over a file
+#   blocks         working out the blocks of a file a query can match in
+#                  (Index.candidate_regions)
+#   verify         the whole verification of the candidates (csearch)
+#
+# Counters:
+#   posting_lists  posting lists decoded or iterated
+#   posting_ids    file ids in them
+#   posting_lists_shared
+#                  posting lists of a batch reused by another query
+#                  rather than decoded again (batch.py)
+#   files_opened, bytes_read, read_errors
+#                  of the candidate files verified
+#   candidates, matches
+#   xeger_samples  samples drawn by xegerQuery
+#   blocks, blocks_skipped
+#                  blocks of the candidate files split into blocks, and
+#                  those of them that weren't read as the query can't
+#                  match there
+
+
+class Tracer:
+    """
+    Tracer collects the spans and counters of the code run while it is
+    the current tracer.  It can be shared by threads.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = {}
+        self.counters = {}
+
+    @contextmanager
+    def span(self, name):
+        st = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, 1, perf_counter() - st)
+
+    def add_span(self, name, count, seconds, longest=None):
+        with self.lock:
+            span = self.spans.setdefault(name, [0, 0.0, 0.0])
+            span[0] += count
+            span[1] += seconds
+            span[2] = max(span[2], seconds if longest is None else longest)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, report):
+        """
+        merge adds a report of another tracer, such as one of a worker process, to this one.
+        """
+        for name, span in report["spans"].items():
+            self.add_span(name, span["count"], span["seconds"], span["max"])
+        for name, n in report["counters"].items():
+            self.count(name, n)
+
+    def report(self):
+        """
+        report returns the spans and counters as a JSON serializable dict.
+        """
+        with self.lock:
+            return {"spans": {name: {"count": count, "seconds": seconds, "max": longest}
+                              for name, (count, seconds, longest) in self.spans.items()},
+                    "counters": dict(self.counters)}
+
+
+class NullTracer:
+    """
+    NullTracer is the tracer when tracing is off: it records nothing.
+    """
+
+    enabled = False
+
+    def span(self, name):
+        return nullcontext()
+
+    def count(self, name, n=1):
+        pass
+
+    def merge(self, report):
+        pass
+
+
+NULL = NullTracer()
+tracer = NULL
+
+
+def get_tracer():
+    return tracer
+
+
+def set_tracer(t):
+    """
+    set_tracer makes t the current tracer, or turns tracing off if t is None.
+    It returns the previous tracer.
+    """
+    global tracer
+    prev = tracer
+    tracer = NULL if t is None else t
+    return prev
+
+
+@contextmanager
+def using(t):
+    """
+    using makes t the current tracer for the duration of the with block.
+    """
+    prev = set_tracer(t)
+    try:
+        yield t
+    finally:
+        set_tracer(prev)
+
+
+def span(name):
+    return tracer.span(name)
+
+
+def count(name, n=1):
+    tracer.count(name, n)
@@ -0,0 +1,566 @@
+import mmap
+import os
+import re
+from collections import namedtuple
+from contextlib import closing
+from itertools import islice
+from multiprocessing import Pool
+from time import time
+import tracing
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# regex, mmap threshold and prefilter of the pool worker processes, and
+# whether they trace, set by init_worker
+worker_regex = None
+worker_threshold = None
+worker_prefilter = None
+worker_traced = False
+
+# Parts of a regex a line local search can handle: none of them match a
+# newline, and anchors give the same answer on a line as on the whole file.
+LINE_CATEGORIES = {sre_parse.CATEGORY_DIGIT, sre_parse.CATEGORY_WORD, sre_parse.CATEGORY_NOT_SPACE,
+                   sre_parse.CATEGORY_NOT_LINEBREAK}
+LINE_ANCHORS = {sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING, sre_parse.AT_BOUNDARY,
+                sre_parse.AT_NON_BOUNDARY}
+NEWLINE = ord("\n")
+# Parts of a regex that only match runs of characters, any number of them,
+# which are the same as runs of the bytes of their utf-8 encoding.
+RUN_OPS = {sre_parse.ANY, sre_parse.NOT_LITERAL, sre_parse.IN}
+
+# A line holding a match: the file, the line number and column (from 1) of
+# the start of the match, the text of the lines the match covers, and the
+# lists of context lines before and after them.  For a bytes regex the
+# column counts bytes and the text is decoded for display.
+LineMatch = namedtuple("LineMatch", "file line column text before after")
+
+
+def single_line(regex):
+    """
+    single_line reports whether every match of the compiled regex lies
+    within one line and matches the same when searching only that line.
+    It is conservative: unusual constructs make it return False.
+    """
+    pattern = regex.pattern
+    if isinstance(pattern, bytes):
+        pattern = pattern.decode("latin-1")
+    try:
+        tree = sre_parse.parse(pattern, regex.flags & ~re.UNICODE if isinstance(regex.pattern, bytes) else regex.flags)
+    except (re.error, TypeError):
+        return False
+    return single_line_tree(tree, tree.state.flags)
+
+
+def single_line_tree(tree, flags):
+    for op, av in tree:
+        if op == sre_parse.LITERAL:
+            if av == NEWLINE:
+                return False
+        elif op == sre_parse.ANY:
+            if flags & re.DOTALL:
+                return False
+        elif op == sre_parse.IN:
+            for item_op, item_av in av:
+                if item_op == sre_parse.LITERAL and item_av == NEWLINE:
+                    return False
+                if item_op == sre_parse.RANGE and item_av[0] <= NEWLINE <= item_av[1]:
+                    return False
+                if item_op == sre_parse.CATEGORY and item_av not in LINE_CATEGORIES:
+                    return False
+                if item_op == sre_parse.NEGATE:
+                    return False
+        elif op == sre_parse.CATEGORY:
+            if av not in LINE_CATEGORIES:
+                return False
+        elif op == sre_parse.AT:
+            # $ is only line local as an end of line.
+            if av not in LINE_ANCHORS and not (av == sre_parse.AT_END and flags & re.MULTILINE):
+                return False
+        elif op == sre_parse.BRANCH:
+            if not all(single_line_tree(sub, flags) for sub in av[1]):
+                return False
+        elif op == sre_parse.SUBPATTERN:
+            _, add_flags, del_flags, sub = av
+            if not single_line_tree(sub, (flags | add_flags) & ~del_flags):
+                return False
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, sre_parse.POSSESSIVE_REPEAT):
+            if not single_line_tree(av[2], flags):
+                return False
+        elif op == sre_parse.ATOMIC_GROUP:
+            if not single_line_tree(av, flags):
+                return False
+        else:
+            return False
+    return True
+
+
+class Prefilter:
+    """
+    Prefilter holds the literals one of which occurs in every match of a
+    regex (see gcs.requiredLiterals).  A file with none of them is rejected
+    with str/bytes find, without running the regex.  If the regex is
+    single_line, it is only run on the lines holding a literal.
+    rejected counts the files rejected by this process.
+    """
+
+    # Past this many hits the lines aren't worth searching one by one.
+    max_windows = 16
+
+    def __init__(self, literals, regex):
+        self.literals = literals
+        self.bliterals = [lit.encode("utf-8") for lit in literals]
+        self.line_local = single_line(regex)
+        self.rejected = 0
+
+    def admits(self, data):
+        """
+        admits reports whether data, a str, bytes or mmap, holds one of the
+        literals, so the regex may match it.
+        """
+        literals = self.literals if isinstance(data, str) else self.bliterals
+        if any(data.find(lit) >= 0 for lit in literals):
+            return True
+        self.rejected += 1
+        return False
+
+    def search(self, regex, data):
+        """
+        search reports whether regex matches data, a str, bytes or mmap.
+        """
+        if isinstance(data, str):
+            literals, nl = self.literals, "\n"
+        else:
+            literals, nl = self.bliterals, b"\n"
+        hits = []
+        for lit in literals:
+            i = data.find(lit)
+            while i >= 0 and len(hits) <= self.max_windows:
+                hits.append(i)
+                i = data.find(lit, i + 1)
+        if not hits:
+            self.rejected += 1
+            return False
+        if not self.line_local or len(hits) > self.max_windows:
+            return regex.search(data) is not None
+        hits.sort()
+        end = -1
+        for i in hits:
+            if i < end:
+                continue
+            start = data.rfind(nl, 0, i) + 1
+            end = data.find(nl, i)
+            if end < 0:
+                end = len(data)
+            if regex.search(data, start, end):
+                return True
+        return False
+
+
+def matches(regex, data, prefilter):
+    if prefilter is None:
+        return regex.search(data) is not None
+    return prefilter.search(regex, data)
+
+
+def bytes_pattern(regex):
+    """
+    bytes_pattern returns the bytes version of the compiled str regex, or
+    None if it has none that matches the utf-8 encoding of a file where the
+    regex matches the file's text.  Only ascii patterns are converted: a
+    non-ascii character in a class can't be expressed as a set of bytes.
+    Patterns that ignore case, which folds non-ascii letters such as the
+    Kelvin sign onto ascii ones, or have parts that depend on the width of
+    a character (see bytes_exact) keep the text regex.
+    """
+    if not regex.pattern.isascii() or regex.flags & re.IGNORECASE:
+        return None
+    try:
+        tree = sre_parse.parse(regex.pattern, regex.flags)
+        if tree.state.flags & re.IGNORECASE or not bytes_exact(tree):
+            return None
+        return re.compile(regex.pattern.encode("ascii"), regex.flags & ~re.UNICODE)
+    except re.error:
+        return None
+
+
+def bytes_exact(tree):
+    r"""
+    bytes_exact reports whether the parsed ascii pattern matches the same
+    as a bytes pattern as it does as a str one.  Literals and classes of
+    ascii characters match the same bytes as characters, but ., negated
+    classes and \w, \d, \s, \b and their negations see a non-ascii
+    character as one character and its encoding as several bytes, or
+    aren't ascii only on text.  Those are only allowed as x* runs, which
+    match the encoding of a string of characters just as they match it.
+    """
+    for op, av in tree:
+        if op == sre_parse.LITERAL or op == sre_parse.GROUPREF:
+            continue
+        elif op == sre_parse.IN:
+            if any(item_op in (sre_parse.NEGATE, sre_parse.CATEGORY) for item_op, _ in av):
+                return False
+        elif op == sre_parse.AT:
+            if av in (sre_parse.AT_BOUNDARY, sre_parse.AT_NON_BOUNDARY):
+                return False
+        elif op == sre_parse.BRANCH:
+            if not all(bytes_exact(sub) for sub in av[1]):
+                return False
+        elif op == sre_parse.SUBPATTERN:
+            _, add_flags, _, sub = av
+            if add_flags & re.IGNORECASE or not bytes_exact(sub):
+                return False
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, sre_parse.POSSESSIVE_REPEAT):
+            lo, hi, sub = av
+            if lo == 0 and hi == sre_parse.MAXREPEAT and len(sub) == 1 and sub[0][0] in RUN_OPS:
+                if sub[0][0] == sre_parse.IN and any(item_op == sre_parse.CATEGORY for item_op, _ in sub[0][1]):
+                    return False
+                continue
+            if not bytes_exact(sub):
+                return False
+        elif op == sre_parse.ATOMIC_GROUP:
+            if not bytes_exact(av):
+                return False
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            if not bytes_exact(av[1]):
+                return False
+        else:
+            return False
+    return True
+
+
+def newlines(data):
+    r"""
+    newlines returns data, bytes or an mmap, with its \r\n and \r line
+    endings turned into \n, as a text mode read and the index see them.
+    data is returned as it is if it has no \r.
+    """
+    if data.find(b"\r") < 0:
+        return data
+    return data[:].replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+
+def search_file(regex, filename, mmap_threshold=0, prefilter=None):
+    r"""
+    search_file reports whether the compiled regex matches the contents
+    of filename.  A str regex runs over the decoded text; bytes that aren't
+    utf-8, in a file in another encoding, are kept as surrogate escapes
+    rather than failing the search.  A bytes regex runs over the
+    raw bytes, reading files smaller than mmap_threshold and mapping the
+    others, so they are never decoded or copied unless they have \r line
+    endings (see newlines).
+    Files that can't be read don't match.  If given, prefilter is tried first.
+    """
+    try:
+        if isinstance(regex.pattern, str):
+            with tracing.span("read"), open(filename, 'r', errors='surrogateescape') as f:
+                tracing.count("files_opened")
+                tracing.count("bytes_read", os.fstat(f.fileno()).st_size)
+                data = f.read()
+            with tracing.span("regex"):
+                return matches(regex, data, prefilter)
+        with open(filename, 'rb') as f:
+            tracing.count("files_opened")
+            size = os.fstat(f.fileno()).st_size
+            tracing.count("bytes_read", size)
+            if size < max(mmap_threshold, 1):
+                with tracing.span("read"):
+                    data = newlines(f.read())
+                with tracing.span("regex"):
+                    return matches(regex, data, prefilter)
+            with tracing.span("read"):
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            with m, tracing.span("regex"):
+                return matches(regex, newlines(m), prefilter)
+    except OSError:
+        tracing.count("read_errors")
+        return False
+
+
+def search_regions(regex, filename, regions):
+    """
+    search_regions reports whether the compiled regex matches in one of
+    the (start, end) byte ranges of filename, end None for the end of the
+    file, reading just those.  The ranges must start at the start of a
+    line and the regex must be single_line, so that a match in the file is
+    a match in a range.  A str regex runs over the range decoded as
+    search_file would see it.
+    """
+    nl = "\n" if isinstance(regex.pattern, str) else b"\n"
+    try:
+        with open(filename, 'rb') as f:
+            tracing.count("files_opened")
+            for start, end in regions:
+                with tracing.span("read"):
+                    f.seek(start)
+                    data = f.read() if end is None else f.read(end - start)
+                tracing.count("bytes_read", len(data))
+                data = newlines(data)
+                if isinstance(nl, str):
+                    data = data.decode("utf-8", "surrogateescape")
+                with tracing.span("regex"):
+                    # With the newline before the range, ^ and \b see what they would in the file.
+                    if regex.search(nl + data, 1) if start else regex.search(data):
+                        return True
+    except OSError:
+        tracing.count("read_errors")
+    return False
+
+
+def search_item(regex, item, mmap_threshold=0, prefilter=None):
+    """
+    search_item searches a file name or a (file name, regions) pair (see
+    search_regions) and returns the name if the regex matches, else None.
+    """
+    if isinstance(item, str):
+        return item if search_file(regex, item, mmap_threshold, prefilter) else None
+    filename, regions = item
+    return filename if search_regions(regex, filename, regions) else None
+
+
+def display(text):
+    return text if isinstance(text, str) else text.decode("utf-8", "replace")
+
+
+def count_newlines(data, nl, start, end):
+    # mmap has no count.
+    if isinstance(data, mmap.mmap):
+        return data[start:end].count(nl)
+    return data.count(nl, start, end)
+
+
+def context_lines(data, nl, begin, end, n):
+    """
+    context_lines returns the up to n lines before the line starting at
+    begin and the up to n lines after the line ending at end.
+    """
+    before = []
+    i = begin
+    while len(before) < n and i > 0:
+        j = data.rfind(nl, 0, i - 1) + 1
+        before.append(display(data[j:i - 1]))
+        i = j
+    before.reverse()
+    after = []
+    i = end
+    while len(after) < n and i + 1 < len(data):
+        j = data.find(nl, i + 1)
+        if j < 0:
+            j = len(data)
+        after.append(display(data[i + 1:j]))
+        i = j
+    return before, after
+
+
+def line_matches(regex, data, filename, context=0, max_count=None):
+    """
+    line_matches yields the LineMatch of each line of data, a str, bytes or
+    mmap, where a match of regex starts, stopping after max_count of them.
+    Searching resumes after the lines a match covers, so a line is reported
+    once.  Line numbers are counted from the match offsets as they are
+    found; data is never split into lines.
+    """
+    nl = "\n" if isinstance(data, str) else b"\n"
+    lineno = 1
+    counted = 0
+    pos = 0
+    n = 0
+    while pos <= len(data) and n != max_count:
+        m = regex.search(data, pos)
+        if m is None:
+            return
+        start = m.start()
+        lineno += count_newlines(data, nl, counted, start)
+        counted = start
+        begin = data.rfind(nl, 0, start) + 1
+        # A match ending with a newline covers the line up to it.
+        end = data.find(nl, max(m.end() - 1, start))
+        if end < 0:
+            end = len(data)
+        before, after = context_lines(data, nl, begin, end, context) if context else ([], [])
+        yield LineMatch(filename, lineno, start - begin + 1, display(data[begin:end]), before, after)
+        n += 1
+        pos = end + 1
+
+
+def search_lines(regex, filename, mmap_threshold=0, prefilter=None, context=0, max_count=None):
+    """
+    search_lines yields the LineMatch of the lines of filename the compiled
+    regex matches, reading the file as search_file does.  The file is only
+    read once the first line is asked for.
+    """
+    try:
+        if isinstance(regex.pattern, str):
+            with tracing.span("read"), open(filename, 'r', errors='surrogateescape') as f:
+                tracing.count("files_opened")
+                tracing.count("bytes_read", os.fstat(f.fileno()).st_size)
+                data = f.read()
+            if prefilter is None or prefilter.admits(data):
+                yield from line_matches(regex, data, filename, context, max_count)
+            return
+        with open(filename, 'rb') as f:
+            tracing.count("files_opened")
+            size = os.fstat(f.fileno()).st_size
+            tracing.count("bytes_read", size)
+            if size < max(mmap_threshold, 1):
+                with tracing.span("read"):
+                    data = newlines(f.read())
+                if prefilter is None or prefilter.admits(data):
+                    yield from line_matches(regex, data, filename, context, max_count)
+                return
+            with tracing.span("read"):
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            with m:
+                data = newlines(m)
+                if prefilter is None or prefilter.admits(data):
+                    yield from line_matches(regex, data, filename, context, max_count)
+    except OSError:
+        tracing.count("read_errors")
+
+
+def search_chunk(regex, file_names, mmap_threshold=0, prefilter=None):
+    """
+    search_chunk searches a chunk of files and returns the pid of the
+    process, the number of files, the names that matched, the time taken
+    and the number of files rejected by the prefilter.
+    """
+    st = time()
+    rejected = prefilter.rejected if prefilter is not None else 0
+    matched = [filename for filename in (search_item(regex, item, mmap_threshold, prefilter) for item in file_names)
+               if filename is not None]
+    rejected = prefilter.rejected - rejected if prefilter is not None else 0
+    return os.getpid(), len(file_names), matched, time() - st, rejected
+
+
+def init_worker(regex, mmap_threshold, prefilter, traced=False):
+    global worker_regex, worker_threshold, worker_prefilter, worker_traced
+    worker_regex = regex
+    worker_threshold = mmap_threshold
+    worker_prefilter = prefilter
+    worker_traced = traced
+
+
+def search_worker(file_names):
+    """
+    search_worker searches a chunk in a pool worker, see search_chunk.
+    If the parent traces, the report of the chunk's trace is appended,
+    for the parent to merge.
+    """
+    if not worker_traced:
+        return search_chunk(worker_regex, file_names, worker_threshold, worker_prefilter)
+    with tracing.using(tracing.Tracer()) as tracer:
+        res = search_chunk(worker_regex, file_names, worker_threshold, worker_prefilter)
+    return res + (tracer.report(),)
+
+
+def chunks(iterable, size):
+    """
+    chunks splits iterable into lists of size items, reading it lazily.
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def prepare(regex, mmap_threshold=None, literals=None):
+    """
+    prepare returns the regex, mmap threshold and prefilter to search
+    files with, for the options of verify.
+    """
+    if mmap_threshold is not None:
+        regex = bytes_pattern(regex) or regex
+    else:
+        mmap_threshold = 0
+    # Literal search is case sensitive.
+    prefilter = Prefilter(literals, regex) if literals and not regex.flags & re.IGNORECASE else None
+    return regex, mmap_threshold, prefilter
+
+
+def search_files(regex, file_names, mmap_threshold=None, literals=None):
+    """
+    search_files yields the names in file_names whose contents the compiled
+    regex matches, one at a time in this process, as verify does.
+    """
+    regex, mmap_threshold, prefilter = prepare(regex, mmap_threshold, literals)
+    for item in file_names:
+        filename = search_item(regex, item, mmap_threshold, prefilter)
+        if filename is not None:
+            tracing.count("matches")
+            yield filename
+
+
+def iter_matches(regex, file_names, mmap_threshold=None, literals=None, context=0, max_count=None, limit=None):
+    """
+    iter_matches yields the LineMatch of each line the compiled regex
+    matches in file_names, file by file in order, in this process.  At most
+    max_count lines are reported per file and limit in all.  Files are only
+    read as their lines are consumed, and file_names is only advanced past
+    a file once it has been searched, so once limit is reached, or the
+    consumer stops, no more files are read and a lazy file_names (see
+    search.candidate_files) evaluates no more candidates.  The other options
+    are those of verify.
+    """
+    if limit is not None and limit <= 0:
+        return
+    regex, mmap_threshold, prefilter = prepare(regex, mmap_threshold, literals)
+    n = 0
+    for filename in file_names:
+        found = False
+        with closing(search_lines(regex, filename, mmap_threshold, prefilter, context, max_count)) as lines:
+            for match in lines:
+                found = True
+                yield match
+                n += 1
+                if n == limit:
+                    break
+        if found:
+            tracing.count("matches")
+        if n == limit:
+            return
+
+
+def verify(regex, file_names, jobs=1, chunk_size=64, mmap_threshold=None, literals=None):
+    """
+    verify returns the names in file_names whose contents the compiled
+    regex matches, in the order they were given, and per process stats
+    as {pid: [files searched, matches, seconds, rejected by the prefilter]}.
+    If literals are given, one of which is in every match, files are
+    checked for them before running the regex (see Prefilter).
+    If mmap_threshold is set and the regex has a bytes version matching
+    the same files (see bytes_pattern), files are searched as bytes,
+    mmapping those of at least mmap_threshold bytes.
+    An entry of file_names can also be a (name, regions) pair, of which
+    only the regions are searched, see search_regions.
+    With jobs > 1 the files are split into chunks that are searched by a
+    pool of jobs processes; chunk results are collected in order, so the
+    output is the same as that of a serial search.
+    """
+    matched = []
+    workers = {}
+    regex, mmap_threshold, prefilter = prepare(regex, mmap_threshold, literals)
+
+    def collect(pid, nfiles, found, dur, rejected, report=None):
+        if report is not None:
+            tracing.get_tracer().merge(report)
+        tracing.count("matches", len(found))
+        stats = workers.setdefault(pid, [0, 0, 0.0, 0])
+        stats[0] += nfiles
+        stats[1] += len(found)
+        stats[2] += dur
+        stats[3] += rejected
+        matched.extend(found)
+
+    if jobs > 1:
+        initargs = (regex, mmap_threshold, prefilter, tracing.get_tracer().enabled)
+        with Pool(jobs, initializer=init_worker, initargs=initargs) as pool:
+            for res in pool.imap(search_worker, chunks(file_names, chunk_size)):
+                collect(*res)
+    else:
+        for chunk in chunks(file_names, chunk_size):
+            collect(*search_chunk(regex, chunk, mmap_threshold, prefilter))
+    return matched, workers